@@ -0,0 +1,103 @@
+"""
+Grid row layout for large carousels: the dynamic-programming partition in
+`partition_rows` against the graph + dijkstra search it replaced
+(reproduced below), which copied the whole path at every step. Also checks
+that both pick rows of the same total cost. The scaling `plan_grid` applies
+afterwards (`cap_plan`) is left out, as the old layout had none.
+
+    python benchmarks/bench_grid_layout.py [rounds]
+"""
+
+import heapq
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from internal.grid_layout import MAX_ROW_HEIGHT, partition_rows  # noqa: E402
+
+
+def dijkstra(graph, start, end):
+    heap = [(0, start, [])]  # (cost, current_node, path)
+    visited = set()
+
+    while heap:
+        cost, node, path = heapq.heappop(heap)
+        if node in visited:
+            continue
+        visited.add(node)
+        path = path + [node]
+        if node == end:
+            return path
+        for neighbor, weight in graph.get(node, []):
+            if neighbor not in visited:
+                heapq.heappush(heap, (cost + weight, neighbor, path))
+    return []
+
+
+def get_height(images_wh, canvas_width):
+    return canvas_width / sum(w / h for w, h in images_wh)
+
+
+def graph_layout(dims):
+    """The previous layout: rows as a shortest path over breakpoints."""
+    im_meta = list(dims) + [(0, 0)]
+    avg_w = sum(w for w, h in im_meta) / len(im_meta)
+    canvas_w = int(avg_w * 1.5)
+
+    graph = defaultdict(list)
+    n = len(im_meta) - 1
+    for i in range(n):
+        for j in range(i + 1, min(i + 4, len(im_meta))):
+            cost = (MAX_ROW_HEIGHT - get_height(im_meta[i:j], canvas_w)) ** 2
+            graph[i].append((j, cost))
+    path = dijkstra(graph, 0, n)
+    return canvas_w, path
+
+
+def layout_cost(dims, canvas_w, breaks):
+    return sum(
+        (MAX_ROW_HEIGHT - get_height(dims[u:v], canvas_w)) ** 2
+        for u, v in zip(breaks, breaks[1:])
+    )
+
+
+def random_dims(n):
+    sizes = [(1080, 1350), (1080, 1080), (1080, 566), (640, 800), (1440, 1800)]
+    return [random.choice(sizes) for _ in range(n)]
+
+
+def bench(fn, dims, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(dims)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    random.seed(0)
+    for n in (10, 20, 100, 1000, 5000):
+        dims = random_dims(n)
+
+        canvas_w, path = graph_layout(dims)
+        plan = partition_rows(dims)
+        breaks = [0] + [end for _, end, _ in plan.rows]
+        old_cost = layout_cost(dims, canvas_w, path)
+        new_cost = layout_cost(dims, plan.width, breaks)
+        assert canvas_w == plan.width
+        assert abs(old_cost - new_cost) <= 1e-6 * max(1.0, old_cost), n
+
+        old = bench(graph_layout, dims, rounds)
+        new = bench(partition_rows, dims, rounds)
+        print(
+            f"{n:5} images: graph {old * 1000:8.3f}ms  "
+            f"dp {new * 1000:8.3f}ms  ({old / new:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Compare a fresh aiohttp.ClientSession per call (the old HTTPSession
+behaviour) with the shared, pooled upstream session.
+
+A local aiohttp server stands in for instagram.com. When `openssl` is
+available the stand-in speaks TLS with a throwaway self-signed
+certificate, so the numbers include the handshake cost.
+
+    python benchmarks/bench_http_pool.py [requests] [concurrency]
+"""
+
+import asyncio
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from scrapers.data import HTTPSession, close_client_session  # noqa: E402
+
+BODY = "x" * 16 * 1024
+
+
+def make_ssl_context(tmpdir: str) -> ssl.SSLContext | None:
+    if not shutil.which("openssl"):
+        return None
+    cert, key = os.path.join(tmpdir, "cert.pem"), os.path.join(tmpdir, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+
+async def start_upstream(ssl_ctx: ssl.SSLContext | None):
+    # Client ephemeral ports identify connections well enough for a benchmark
+    peers = set()
+
+    async def handler(request: web.Request):
+        peers.add(request.transport.get_extra_info("peername"))  # type: ignore
+        return web.Response(text=BODY)
+
+    app = web.Application()
+    app.router.add_get("/p/{post_id}/embed/captioned/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=ssl_ctx)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore
+    scheme = "https" if ssl_ctx else "http"
+    return runner, f"{scheme}://127.0.0.1:{port}", lambda: len(peers)
+
+
+async def fresh_session_get(url: str) -> str:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, ssl=False) as response:
+            return await response.text()
+
+
+async def pooled_get(url: str) -> str:
+    async with HTTPSession() as session:
+        return await session.http_get(url)
+
+
+async def run(name, fetch, base_url, total, concurrency, connections):
+    sem = asyncio.Semaphore(concurrency)
+    before = connections()
+
+    async def one(i):
+        async with sem:
+            await fetch(f"{base_url}/p/post{i}/embed/captioned/")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:>14}: {total} req in {elapsed:.3f}s "
+        f"({total / elapsed:,.0f} req/s, {elapsed / total * 1e3:.2f} ms/req), "
+        f"{connections() - before} upstream connections"
+    )
+
+
+async def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ssl_ctx = make_ssl_context(tmpdir)
+        runner, base_url, connections = await start_upstream(ssl_ctx)
+        print(f"upstream: {base_url} (tls={'yes' if ssl_ctx else 'no'})")
+        try:
+            await run("fresh session", fresh_session_get, base_url, total, concurrency, connections)
+            await run("pooled session", pooled_get, base_url, total, concurrency, connections)
+        finally:
+            await close_client_session()
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
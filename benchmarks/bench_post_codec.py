@@ -0,0 +1,85 @@
+"""
+Compare scrapers.codec against marshal on realistic carousel posts:
+encoded size, encode time and decode time.
+
+    python benchmarks/bench_post_codec.py [iterations]
+"""
+
+import marshal
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from scrapers.codec import decode_post, encode_post  # noqa: E402
+from scrapers.data import Media, Post, User  # noqa: E402
+
+
+def cdn_url(rng: random.Random) -> str:
+    token = "".join(rng.choices(string.ascii_letters + string.digits, k=120))
+    return (
+        f"https://scontent-iad3-1.cdninstagram.com/v/t51.29350-15/"
+        f"{rng.randrange(10**17, 10**18)}_n.jpg?stp=dst-jpg_e35&_nc_ht=scontent"
+        f"&_nc_cat=1&_nc_ohc={token}&oh=00_{token[:40]}&oe=6{rng.randrange(10**6)}"
+    )
+
+
+def make_post(rng: random.Random, n_medias: int) -> Post:
+    medias = []
+    for _ in range(n_medias):
+        url = cdn_url(rng)
+        is_video = rng.random() < 0.2
+        medias.append(
+            Media(
+                url=cdn_url(rng) if is_video else url,
+                type="GraphVideo" if is_video else "GraphImage",
+                width=1080,
+                height=rng.choice((1080, 1350, 566)),
+                duration=0,
+                preview_url=url,
+            )
+        )
+    return Post(
+        post_id="".join(rng.choices(string.ascii_letters, k=11)),
+        user=User(
+            username="some.creator",
+            full_name="Some Creator",
+            profile_pic=cdn_url(rng),
+        ),
+        caption=" ".join(rng.choices(("lorem", "ipsum", "#travel", "🌊"), k=60)),
+        medias=medias,
+        blocked=False,
+        timestamp=1_700_000_000 + rng.randrange(10**7),
+        likes_count=rng.randrange(10**6),
+        comments_count=rng.randrange(10**4),
+    )
+
+
+def bench(name, encode, decode, posts, iterations):
+    blobs = [encode(p) for p in posts]
+    assert all(decode(b) == p for b, p in zip(blobs, posts))
+    size = sum(len(b) for b in blobs) / len(blobs)
+    enc = timeit.timeit(lambda: [encode(p) for p in posts], number=iterations)
+    dec = timeit.timeit(lambda: [decode(b) for b in blobs], number=iterations)
+    per = iterations * len(posts)
+    print(
+        f"{name:>8}: {size:8.0f} B/post  "
+        f"encode {enc / per * 1e6:7.2f} us  decode {dec / per * 1e6:7.2f} us"
+    )
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = random.Random(42)
+    for n_medias in (1, 4, 10, 20):
+        posts = [make_post(rng, n_medias) for _ in range(20)]
+        print(f"--- {n_medias} media(s) per post")
+        bench("marshal", marshal.dumps, marshal.loads, posts, iterations)
+        bench("codec", encode_post, decode_post, posts, iterations)
+
+
+if __name__ == "__main__":
+    main()
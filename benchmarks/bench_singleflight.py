@@ -0,0 +1,102 @@
+"""
+Singleflight under load: thousands of keys, each with many concurrent
+waiters. The lock-based implementation it replaced is reproduced below
+for comparison.
+
+    python benchmarks/bench_singleflight.py [keys] [waiters_per_key]
+"""
+
+import asyncio
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from internal.singleflight import Singleflight  # noqa: E402
+
+
+class LockedSingleflight:
+    """The previous implementation: one global asyncio.Lock on entry and cleanup."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = asyncio.Lock()
+
+    async def do(self, key, fn, *args):
+        async with self._lock:
+            if key in self._calls:
+                task = self._calls[key]
+            else:
+
+                async def task_wrapper():
+                    try:
+                        return await fn(*args)
+                    finally:
+                        async with self._lock:
+                            if self._calls.get(key) is task:
+                                del self._calls[key]
+
+                task = asyncio.create_task(task_wrapper())
+                self._calls[key] = task
+        return await task
+
+
+async def work(key):
+    await asyncio.sleep(0.001)
+    return key
+
+
+async def late_callers(keys):
+    # callers arriving right after the first call finished
+    for retain in (0.0, 1.0):
+        sf = Singleflight(retain=retain)
+        await asyncio.gather(*(sf.do(k, work, k) for k in range(keys)))
+        await asyncio.gather(*(sf.do(k, work, k) for k in range(keys)))
+        print(
+            f"retain={retain}: 2 x {keys} sequential waves, "
+            f"fn ran {sf.executions} times, dedupe ratio {sf.stats['dedupe_ratio']:.2f}"
+        )
+
+
+async def main():
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    waiters = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    executions = {}
+
+    async def counted(key):
+        executions[key] = executions.get(key, 0) + 1
+        return await work(key)
+
+    async def run_counted(name, make_sf, rounds=3):
+        # best of a few rounds, alternating implementations would otherwise
+        # mostly measure the allocator warming up
+        best = float("inf")
+        for _ in range(rounds):
+            sf = make_sf()
+            executions.clear()
+            calls = [sf.do(k, counted, k) for k in range(keys) for _ in range(waiters)]
+            gc.collect()
+            start = time.perf_counter()
+            await asyncio.gather(*calls)
+            best = min(best, time.perf_counter() - start)
+        total = keys * waiters
+        print(
+            f"{name:>9}: {total} calls on {keys} keys in {best:.3f}s "
+            f"({total / best:,.0f} calls/s), fn ran {sum(executions.values())} times"
+        )
+        return sf
+
+    await run_counted("locked", LockedSingleflight)
+    sf = await run_counted("lock-free", Singleflight)
+    print(f"lock-free stats: {sf.stats}")
+    await late_callers(keys)
+
+
+if __name__ == "__main__":
+    import uvloop
+
+    uvloop.install()
+    asyncio.run(main())
@@ -1,78 +1,843 @@
+import asyncio
+import contextlib
+import fcntl
+import itertools
+import json
 import os
+import struct
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
 
-from cachetools import LFUCache, cached
+from aiohttp import web
+from cachetools import LRUCache, TLRUCache
+from loguru import logger
 from lsm import LSM
 
+from config import config
+from internal.metrics import collector, family
+
+
+# On-disk entry layout: a fixed header followed by the value.
+#   version (u8) | expires_at (u64) | stored_at (u64) | value
+# Timestamps are in ns, big endian. Version 1 had no stored_at.
+ENTRY_VERSION = 2
+ENTRY_HEADER = struct.Struct(">BQQ")
+ENTRY_HEADER_V1 = struct.Struct(">BQ")
+# Expiry index rows live in the same database, under a prefix that sorts
+# before every data key:  prefix | expires_at (u64, big endian) | key
+EXPIRY_PREFIX = b"\x00e"
+EXPIRY_TS = struct.Struct(">Q")
+
+# A batch of writes that fails this many times in a row is dropped
+FLUSH_ATTEMPTS = 5
+
+
+class CacheEntry(NamedTuple):
+    value: bytes
+    # both in ns since the epoch; stored_at is 0 when unknown
+    expires_at: int
+    stored_at: int
+
+
+def encode_entry(entry: CacheEntry) -> bytes:
+    return ENTRY_HEADER.pack(ENTRY_VERSION, entry.expires_at, entry.stored_at) + (
+        entry.value
+    )
+
+
+def decode_entry(raw: bytes) -> CacheEntry | None:
+    """Returns None for a value not written by `encode_entry`."""
+    if len(raw) >= ENTRY_HEADER.size and raw[0] == ENTRY_VERSION:
+        _, expires_at, stored_at = ENTRY_HEADER.unpack_from(raw)
+        return CacheEntry(raw[ENTRY_HEADER.size :], expires_at, stored_at)
+    if len(raw) >= ENTRY_HEADER_V1.size and raw[0] == 1:
+        _, expires_at = ENTRY_HEADER_V1.unpack_from(raw)
+        return CacheEntry(raw[ENTRY_HEADER_V1.size :], expires_at, 0)
+    return None
+
+
+def expiry_key(key: bytes, expires_at: int) -> bytes:
+    return EXPIRY_PREFIX + EXPIRY_TS.pack(expires_at) + key
+
 
 class Cache:
-    def __init__(self, db_path="cache.db", ttl=300):
+    """
+    LSM backed key/value store with a TTL, accessed off the event loop.
+
+    Every value is stored with its expiry in a small header, so expired
+    entries are detected on read; an expiry index kept in the same
+    database lets the evictor find them with a range scan.
+
+    All LSM calls run on a dedicated single-thread executor (the handles
+    are not safe to share between threads). Writes are buffered and group
+    committed in one transaction every `flush_interval` seconds or
+    `flush_entries` entries, whichever comes first; buffered values are
+    visible to `get` straight away.
+    """
+
+    def __init__(
+        self,
+        db_path="cache.db",
+        ttl=300,
+        flush_interval: float = 0.05,
+        flush_entries: int = 256,
+        legacy_ttl: int | None = None,
+    ):
         self.db_path = db_path
-        self.ttl_path = db_path + ".ttl"
+        self.ttl = ttl
         self.ttl_ns = ttl * 1000 * 1000 * 1000
-        self._counter = 0
-        self.init_cache()
+        # TTL that entries written without stored_at were stored with,
+        # to date them from their expiry
+        legacy_ttl = ttl if legacy_ttl is None else legacy_ttl
+        self.legacy_ttl_ns = legacy_ttl * 1000 * 1000 * 1000
+        self.flush_interval = flush_interval
+        self.flush_entries = flush_entries
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.flushes = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lsm")
+        # Buffered writes as key -> CacheEntry, and the batch
+        # currently being committed
+        self._pending: dict = {}
+        self._writing: dict = {}
+        self._batch: asyncio.Future | None = None
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._flush_task: asyncio.Task | None = None
+        self._flush_failures = 0
+        self._closing = False
+        self._opening: Future | None = None
+
+    def open(self) -> None:
+        """
+        Start opening the database in the background. Every LSM call runs
+        on the same single-thread executor, so anything submitted after
+        this waits for it; calling it again does nothing.
+        """
+        if self._opening is None:
+            self._opening = self._executor.submit(self.init_cache)
 
     def init_cache(self):
+        start = time.perf_counter()
         self.db = LSM(self.db_path)
-        self.ttl_db = LSM(self.ttl_path)
-        self.evict()
+        # Several worker processes may open the same database. LSM lets
+        # only one connection write at a time, and a second one fails with
+        # "Busy" (and leaves python-lsm's transaction depth broken), so
+        # writers take this lock first instead.
+        self._lock_fd = os.open(self.db_path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        if os.path.exists(self.db_path + ".ttl"):
+            with self.write_lock():
+                # Another process may have migrated it meanwhile
+                if os.path.exists(self.db_path + ".ttl"):
+                    self.migrate_ttl_db(self.db_path + ".ttl")
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"[{self.db_path}] Opened in {elapsed:.1f}ms")
+
+    @contextlib.contextmanager
+    def write_lock(self):
+        """Exclusive across processes, held around every write transaction."""
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def migrate_ttl_db(self, ttl_path: str):
+        """
+        Convert a cache written with the old `<db>.ttl` side database:
+        values get the expiry header and the side database is replaced by
+        expiry index rows, then removed.
+        """
+        start = time.perf_counter()
+        ttl_db = LSM(ttl_path)
+        expiries = {}
+        for expires_at, key in ttl_db:
+            expires_at = int(expires_at.split(b".")[0])
+            expiries[key] = max(expires_at, expiries.get(key, 0))
+        ttl_db.close()
+
+        now = time.time_ns()
+        migrated = 0
+        with self.db.transaction() as txn:
+            for key, value in self.db:
+                # Skip index rows and entries already in the new format
+                if key.startswith(EXPIRY_PREFIX) or decode_entry(value):
+                    continue
+                if key in expiries:
+                    expires_at = expiries[key]
+                    stored_at = expires_at - self.legacy_ttl_ns
+                else:
+                    expires_at, stored_at = now + self.ttl_ns, now
+                self.db[key] = encode_entry(CacheEntry(value, expires_at, stored_at))
+                self.db[expiry_key(key, expires_at)] = b""
+                migrated += 1
+            txn.commit()
 
-    def set(self, key, value):
-        self.db[key] = value
-        self.ttl_db[str(time.time_ns() + self.ttl_ns)] = key
+        for suffix in ("", "-log", "-shm"):
+            if os.path.exists(ttl_path + suffix):
+                os.remove(ttl_path + suffix)
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"[{self.db_path}] Migrated {migrated} keys in {elapsed:.1f}ms")
 
-        # Evict every 1000 requests
-        self._counter += 1
-        if self._counter % 1000 == 0:
-            self._counter = 0
-            self.evict()
+    async def _run(self, fn, *args):
+        self.open()
+        if self._opening.done():
+            # Raises if the database could not be opened
+            self._opening.result()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
 
-    def get(self, key):
+    def _get(self, key) -> CacheEntry | None:
         try:
-            return self.db[key]
+            entry = decode_entry(self.db[key])
         except KeyError:
             return None
+        if entry and not entry.stored_at:
+            # Best guess for entries written without stored_at
+            entry = entry._replace(
+                stored_at=entry.expires_at - self.legacy_ttl_ns
+            )
+        return entry
 
-    def evict(self):
-        expired = list(self.ttl_db["0" : str(time.time_ns())])
-        with self.ttl_db.transaction() as txn:
-            for key, value in expired:
-                self.ttl_db.delete(key)
+    def _write_batch(self, items: dict):
+        with self.write_lock(), self.db.transaction() as txn:
+            for key, entry in items.items():
+                self.db[key] = encode_entry(entry)
+                raw_key = key if isinstance(key, bytes) else key.encode()
+                self.db[expiry_key(raw_key, entry.expires_at)] = b""
             txn.commit()
 
-        with self.db.transaction() as txn:
-            for key, value in expired:
-                self.db.delete(value)
+    async def get_entry(self, key) -> CacheEntry | None:
+        """Returns the entry for a live key, None otherwise."""
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._writing.get(key)
+        if entry is None:
+            entry = await self._run(self._get, key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.time_ns():
+            # Left for the evictor to delete
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    async def get(self, key) -> bytes | None:
+        entry = await self.get_entry(key)
+        return entry.value if entry else None
+
+    def set(self, key, value, ttl: int | None = None) -> asyncio.Future:
+        """
+        Buffer a write, expiring after `ttl` seconds (the cache TTL by
+        default). The returned future resolves to True once the entry has
+        been committed to disk, or False if the write was given up on;
+        awaiting it is optional.
+        """
+        loop = asyncio.get_running_loop()
+        ttl_ns = self.ttl_ns if ttl is None else ttl * 1000 * 1000 * 1000
+        now = time.time_ns()
+        self._pending[key] = CacheEntry(value, now + ttl_ns, now)
+        if self._batch is None:
+            self._batch = loop.create_future()
+        batch = self._batch
+
+        if len(self._pending) >= self.flush_entries:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._start_flush)
+        return batch
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # A running flush picks up whatever got buffered in the meantime
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            items, self._pending = self._pending, {}
+            batch, self._batch = self._batch, None
+            self._writing = items
+            try:
+                await self._run(self._write_batch, items)
+            except Exception as e:
+                logger.error(f"[{self.db_path}] Failed to write {len(items)} keys: {e}")
+                self._flush_failures += 1
+                if self._closing or self._flush_failures >= FLUSH_ATTEMPTS:
+                    # No retry: the executor is going away, or the batch
+                    # keeps failing
+                    logger.error(
+                        f"[{self.db_path}] Dropping {len(items)} unwritten keys "
+                        f"after {self._flush_failures} attempts"
+                    )
+                    self._flush_failures = 0
+                    if batch is not None and not batch.done():
+                        batch.set_result(False)
+                    if self._closing:
+                        return
+                    continue
+                # Put the batch back (newer values win) and retry later
+                for key, value in items.items():
+                    self._pending.setdefault(key, value)
+                if self._batch is None:
+                    self._batch = batch
+                elif batch is not None:
+                    self._batch.add_done_callback(
+                        lambda f, b=batch: b.done() or b.set_result(f.result())
+                    )
+                if self._flush_handle is None:
+                    self._flush_handle = loop.call_later(
+                        self.flush_interval, self._start_flush
+                    )
+                return
+            finally:
+                self._writing = {}
+
+            self.flushes += 1
+            self._flush_failures = 0
+            if batch is not None and not batch.done():
+                batch.set_result(True)
+
+            if (
+                self._pending
+                and len(self._pending) < self.flush_entries
+                and not self._closing
+            ):
+                if self._flush_handle is None:
+                    self._flush_handle = loop.call_later(
+                        self.flush_interval, self._start_flush
+                    )
+                return
+
+    async def close(self):
+        """
+        Commit every buffered write and release the LSM handles. Writes
+        that fail now are dropped, not retried.
+        """
+        self._closing = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush()
+        if self._pending:
+            logger.error(
+                f"[{self.db_path}] Dropping {len(self._pending)} unwritten keys"
+            )
+
+        if self._opening is not None:
+            try:
+                await asyncio.wrap_future(self._opening)
+            except Exception as e:
+                logger.error(f"[{self.db_path}] Failed to open: {e!r}")
+            else:
+                await self._run(self.db.close)
+                os.close(self._lock_fd)
+        self._executor.shutdown(wait=True)
+
+    def evict_batch(self, limit: int) -> int:
+        """
+        Process up to `limit` expired index rows, deleting the entries they
+        point to. Returns how many rows were processed.
+        """
+        now = EXPIRY_PREFIX + EXPIRY_TS.pack(time.time_ns())
+        rows = list(itertools.islice(self.db[EXPIRY_PREFIX:now], limit))
+        if not rows:
+            return 0
+
+        deleted = 0
+        offset = len(EXPIRY_PREFIX)
+        with self.write_lock(), self.db.transaction() as txn:
+            for row, _ in rows:
+                (expires_at,) = EXPIRY_TS.unpack_from(row, offset)
+                key = row[offset + EXPIRY_TS.size :]
+                self.db.delete(row)
+                # The key may have been set again since, with a later expiry
+                entry = self._get(key)
+                if entry and entry.expires_at <= expires_at:
+                    self.db.delete(key)
+                    deleted += 1
             txn.commit()
+        self.evicted += deleted
+        return len(rows)
+
+    async def evict(self, batch_size: int = 500) -> int:
+        """
+        Delete every expired key, `batch_size` keys at a time. Each batch
+        is a separate job on the LSM executor, so reads and writes queued
+        in the meantime are served between batches.
+        """
+        start = time.perf_counter()
+        evicted = self.evicted
+        while True:
+            count = await self._run(self.evict_batch, batch_size)
+            if count < batch_size:
+                break
+            await asyncio.sleep(0)
+
+        total = self.evicted - evicted
+        elapsed = (time.perf_counter() - start) * 1000
+        log = logger.info if total else logger.debug
+        log(f"[{self.db_path}] Evicted {total} keys in {elapsed:.1f}ms")
+        return total
+
+    async def run_evictor(self, interval: float, batch_size: int = 500):
+        # The first pass waits too, so it does not compete with startup
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict(batch_size)
+            except Exception as e:
+                logger.error(f"[{self.db_path}] Eviction failed: {e}")
 
 
-class LFUGridCache(LFUCache):
-    def __init__(self, maxsize, getsizeof=None):
-        LFUCache.__init__(self, maxsize, getsizeof)
+class MemoryCache:
+    """
+    Bounded in-process cache of decoded values, meant to sit in front of a
+    `Cache`. Entries are evicted least-recently-used once the sum of their
+    sizes exceeds `max_bytes`, and expire individually at `expires_at`.
+    """
 
-    def popitem(self):
-        key, val = LFUCache.popitem(self)
-        # Evict grid by removing the file
+    def __init__(self, max_bytes: int, ttl: int):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # values are (expires_at, value, size)
+        self._cache = TLRUCache(
+            maxsize=max_bytes,
+            ttu=lambda _key, entry, _now: entry[0],
+            timer=time.time,
+            getsizeof=lambda entry: entry[2],
+        )
+
+    def get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, size: int, expires_at: float | None = None):
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
         try:
-            (fname,) = key
-            os.remove(f"cache/grid/{fname}.jpeg")
-        except FileNotFoundError:
+            self._cache[key] = (expires_at, value, size)
+        except ValueError:
+            # Larger than the whole cache, not worth keeping in memory
+            self._cache.pop(key, None)
+
+    def pop(self, key):
+        entry = self._cache.pop(key, None)
+        return entry[1] if entry else None
+
+    @property
+    def size(self) -> int:
+        return self._cache.currsize
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+class ResponseCache:
+    """
+    Bounded LRU of rendered response bodies.
+
+    Each body is stored with the version of the data it was rendered from
+    (e.g. the post's stored_at); a lookup with another version misses, so
+    an updated post is never answered with a stale render.
+    """
+
+    # Rough per-entry overhead of the key, tuple and dict slot
+    OVERHEAD = 200
+
+    def __init__(self, max_bytes: int):
+        self._cache = LRUCache(
+            maxsize=max_bytes, getsizeof=lambda entry: len(entry[1]) + self.OVERHEAD
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version) -> bytes | None:
+        entry = self._cache.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, version, body: bytes):
+        try:
+            self._cache[key] = (version, body)
+        except ValueError:
+            # Larger than the whole cache
             pass
-        return key, val
 
+    @property
+    def size(self) -> int:
+        return self._cache.currsize
 
-@cached(LFUGridCache(maxsize=10_000, getsizeof=None))
-def grid_cache_cb(post_id: str):
-    return f"cache/grid/{post_id}.jpeg"
+
+class GridCache:
+    """
+    Index of the grid images in `directory`, keeping them under
+    `max_bytes` on disk.
+
+    Eviction is LFU with dynamic aging: an entry's priority is its hit
+    count plus the priority of the last evicted entry at the time of its
+    last hit, so grids that were popular once do not stay forever. The
+    index, hit counts included, is saved to `index_path` every
+    `sync_interval` seconds and on shutdown, so it survives restarts.
+
+    Worker processes share the directory. Each one counts its own hits
+    and new files and merges them into the saved index under a file lock
+    when syncing, picking up the other workers' changes at the same time.
+    Only the owner evicts: evicted grids are marked in the index and their
+    files are deleted, off the event loop, a couple of sync intervals
+    later, once every worker has dropped them.
+    """
+
+    # Evict down to this share of max_bytes, not just below it
+    LOW_WATER = 0.9
+
+    def __init__(
+        self, directory: str, index_path: str, max_bytes: int, sync_interval: float
+    ):
+        self.directory = directory
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        # name -> [size, hits, priority]
+        self.entries: dict[str, list[int]] = {}
+        self.size = 0
+        self.age = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.deleted = 0
+        # Until the saved index is loaded, lookups fall back to the files
+        self.loaded = False
+        # Changes since the last sync: name -> hits, name -> size
+        self._hits: dict[str, int] = {}
+        self._added: dict[str, int] = {}
+        self._lock_fd = os.open(index_path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    async def get(self, name: str) -> str | None:
+        """Path of grid `name` if it is cached, counting a hit."""
+        entry = self.entries.get(name)
+        if entry is None and not self.loaded:
+            loop = asyncio.get_running_loop()
+            path = self.path(name)
+            try:
+                size = await loop.run_in_executor(None, os.path.getsize, path)
+            except FileNotFoundError:
+                pass
+            else:
+                self.add(name, size)
+                entry = self.entries[name]
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry[1] += 1
+        entry[2] = self.age + entry[1]
+        self._hits[name] = self._hits.get(name, 0) + 1
+        return self.path(name)
+
+    def add(self, name: str, size: int) -> None:
+        """Index a grid just written to `path(name)`."""
+        if name in self.entries:
+            return
+        self.entries[name] = [size, 1, self.age + 1]
+        self.size += size
+        self._added[name] = size
+
+    @contextlib.contextmanager
+    def _lock(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _load(self) -> dict | None:
+        try:
+            with open(self.index_path, "rb") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"[{self.index_path}] Unreadable grid index, rebuilding: {e}")
+            return None
+
+    def _save(self, index: dict) -> None:
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+
+    def _scan(self, entries: dict[str, list[int]], age: int) -> dict[str, list[int]]:
+        """Match the index with the files actually in the directory."""
+        scanned = {}
+        with os.scandir(self.directory) as it:
+            for file in it:
+                # Renders in progress are written to a .tmp name first
+                if ".tmp" in file.name or not file.is_file():
+                    continue
+                size = file.stat().st_size
+                entry = entries.get(file.name) or [size, 1, age + 1]
+                entry[0] = size
+                scanned[file.name] = entry
+        return scanned
+
+    def _merge(self, hits: dict, added: dict, owner: bool, scan: bool):
+        """
+        Merge local changes into the saved index, evicting as the owner.
+        Runs off the event loop; returns the merged state and the files
+        due for deletion.
+        """
+        now = time.time()
+        delay = 2 * self.sync_interval
+        with self._lock():
+            index = self._load()
+            if index is None:
+                index = {"age": 0, "entries": {}, "evicting": {}}
+                scan = True
+            age = index["age"]
+            entries = index["entries"]
+            # name -> when it was evicted
+            evicting = index["evicting"]
+            if scan:
+                entries = self._scan(entries, age)
+
+            for name, size in added.items():
+                evicting.pop(name, None)
+                entries.setdefault(name, [size, 1, age + 1])
+            for name, count in hits.items():
+                entry = entries.get(name)
+                if entry is not None:
+                    entry[1] += count
+                    entry[2] = age + entry[1]
+
+            size = sum(entry[0] for entry in entries.values())
+            evicted = 0
+            due = []
+            if owner:
+                if size > self.max_bytes:
+                    target = self.max_bytes * self.LOW_WATER
+                    for name in sorted(entries, key=lambda name: entries[name][2]):
+                        if size <= target:
+                            break
+                        entry_size, _, age = entries.pop(name)
+                        size -= entry_size
+                        evicting[name] = now
+                        evicted += 1
+                due = [(name, at) for name, at in evicting.items() if at + delay <= now]
+                for name, _ in due:
+                    del evicting[name]
+
+            self._save({"age": age, "entries": entries, "evicting": evicting})
+        return entries, age, size, evicted, due
+
+    def _delete(self, due: list[tuple[str, float]]) -> int:
+        deleted = 0
+        for name, evicted_at in due:
+            path = self.path(name)
+            try:
+                # Generated again since it was evicted, keep it
+                if os.stat(path).st_mtime > evicted_at:
+                    continue
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    async def sync(self, owner: bool, scan: bool = False) -> None:
+        hits, self._hits = self._hits, {}
+        added, self._added = self._added, {}
+        loop = asyncio.get_running_loop()
+        try:
+            entries, age, size, evicted, due = await loop.run_in_executor(
+                None, self._merge, hits, added, owner, scan
+            )
+        except BaseException:
+            # Keep the changes for the next sync
+            for name, count in hits.items():
+                self._hits[name] = self._hits.get(name, 0) + count
+            self._added.update(added)
+            raise
+
+        # Changes made while merging
+        for name, size_ in self._added.items():
+            if name not in entries:
+                entries[name] = [size_, 1, age + 1]
+                size += size_
+        for name, count in self._hits.items():
+            if entry := entries.get(name):
+                entry[1] += count
+                entry[2] = age + entry[1]
+        self.entries = entries
+        self.age = age
+        self.size = size
+        self.loaded = True
+        self.evictions += evicted
+        if evicted:
+            logger.info(
+                f"[{self.directory}] Evicted {evicted} grids, {size} bytes left"
+            )
+        if due:
+            self.deleted += await loop.run_in_executor(None, self._delete, due)
+
+    async def run_sync(self, owner: bool) -> None:
+        """Load the index (scanning the directory as the owner), then sync."""
+        start = time.perf_counter()
+        try:
+            await self.sync(owner, scan=owner)
+        except Exception as e:
+            logger.error(f"[{self.index_path}] Failed to load the grid index: {e!r}")
+        else:
+            elapsed = (time.perf_counter() - start) * 1000
+            count = len(self.entries)
+            logger.info(f"[{self.index_path}] Loaded {count} grids in {elapsed:.1f}ms")
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync(owner)
+            except Exception as e:
+                logger.error(f"[{self.index_path}] Grid index sync failed: {e!r}")
 
 
 if os.path.exists("cache") is False:
     os.makedirs("cache")
     os.makedirs("cache/grid")
-post_cache = Cache(db_path="cache/post_data.db", ttl=24 * 60 * 60)
-shareid_cache = Cache(db_path="cache/shareid_data.db", ttl=365 * 24 * 60 * 60)
+cache_flush = {
+    "flush_interval": config.get("CACHE_FLUSH_INTERVAL_MS", 50) / 1000,
+    "flush_entries": config.get("CACHE_FLUSH_ENTRIES", 256),
+}
+# Entries are kept up to the hard TTL; past POST_CACHE_SOFT_TTL they are
+# served stale while get_post refreshes them
+post_cache = Cache(
+    db_path="cache/post_data.db",
+    ttl=config.get("POST_CACHE_HARD_TTL", 48 * 60 * 60),
+    # Posts used to be cached for 24h, with no stored_at
+    legacy_ttl=24 * 60 * 60,
+    **cache_flush,
+)
+post_l1_cache = MemoryCache(
+    max_bytes=config.get("POST_L1_MAX_BYTES", 64 * 1024 * 1024), ttl=post_cache.ttl
+)
+shareid_cache = Cache(
+    db_path="cache/shareid_data.db", ttl=365 * 24 * 60 * 60, **cache_flush
+)
+response_cache = ResponseCache(
+    max_bytes=config.get("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+)
+
+grid_cache = GridCache(
+    directory="cache/grid",
+    index_path="cache/grid_index.json",
+    max_bytes=config.get("GRID_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024),
+    sync_interval=config.get("GRID_CACHE_SYNC_INTERVAL", 30),
+)
+
+
+@collector
+def _metrics():
+    caches = {"post": post_cache, "shareid": shareid_cache}
+    for event in ("hits", "misses", "expired", "evicted"):
+        yield family(
+            f"instafix_cache_{event}_total",
+            "counter",
+            f"On-disk cache lookups / entries: {event}",
+            ("cache",),
+            (((name,), getattr(cache, event)) for name, cache in caches.items()),
+        )
+    memory_caches = {"post_l1": post_l1_cache, "response": response_cache}
+    for event in ("hits", "misses"):
+        yield family(
+            f"instafix_memory_cache_{event}_total",
+            "counter",
+            f"In-memory cache lookups: {event}",
+            ("cache",),
+            (
+                ((name,), getattr(cache, event))
+                for name, cache in memory_caches.items()
+            ),
+        )
+    yield family(
+        "instafix_memory_cache_bytes",
+        "gauge",
+        "Size of the in-memory caches",
+        ("cache",),
+        (((name,), cache.size) for name, cache in memory_caches.items()),
+    )
+    yield family(
+        "instafix_grid_cache_entries",
+        "gauge",
+        "Grid images in the index",
+        (),
+        [((), len(grid_cache.entries))],
+    )
+    yield family(
+        "instafix_grid_cache_bytes",
+        "gauge",
+        "Size of the indexed grid images",
+        (),
+        [((), grid_cache.size)],
+    )
+    for event in ("hits", "misses", "evictions", "deleted"):
+        yield family(
+            f"instafix_grid_cache_{event}_total",
+            "counter",
+            f"Grid cache lookups / files: {event}",
+            (),
+            [((), getattr(grid_cache, event))],
+        )
+
+
+# With several worker processes, only the owner runs TTL eviction
+CACHE_OWNER = web.AppKey("cache_owner", bool)
+
 
-# Populate cache
-for file in os.listdir("cache/grid"):
-    grid_cache_cb(file.split(".")[0])
+async def cache_ctx(app):
+    """
+    aiohttp cleanup context running TTL eviction and grid index syncs in
+    the background, and flushing buffered writes on shutdown.
+    """
+    interval = config.get("CACHE_EVICT_INTERVAL", 60)
+    batch_size = config.get("CACHE_EVICT_BATCH", 500)
+    owner = app.get(CACHE_OWNER, True)
+    # Nothing here blocks startup: the databases and the grid index are
+    # loaded in the background while requests are already served
+    post_cache.open()
+    shareid_cache.open()
+    tasks = [asyncio.create_task(grid_cache.run_sync(owner))]
+    if owner:
+        tasks += [
+            asyncio.create_task(cache.run_evictor(interval, batch_size))
+            for cache in (post_cache, shareid_cache)
+        ]
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await grid_cache.sync(owner)
+    await asyncio.gather(post_cache.close(), shareid_cache.close())
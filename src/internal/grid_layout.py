@@ -1,179 +1,394 @@
-import heapq
+import asyncio
+import importlib
+import math
+import mmap
 import os
 import tempfile
-from collections import defaultdict
-from typing import List, Optional
+import time
+from typing import TYPE_CHECKING, List, NamedTuple, Optional, Sequence
 
-import aiohttp
-import pyvips
+from loguru import logger
+
+from config import config
+from internal.metrics import Histogram
+from internal.render_pool import RenderPool
+from scrapers.data import HTTPSession
+
+# pyvips (and libvips behind it) is slow to load, and only needed once a
+# grid is rendered: it is imported on first use, or warmed up by
+# grid_pool_ctx after startup
+if TYPE_CHECKING:
+    import pyvips
 
 MAX_ROW_HEIGHT = 1000
+MAX_ROW_IMAGES = 3
+# Grids larger than this are scaled down as a whole. WebP cannot go
+# beyond 16383 pixels on either side.
+GRID_MAX_PIXELS = config.get("GRID_MAX_PIXELS", 12_000_000)
+GRID_MAX_SIDE = 16383
+# Save options per output format, picked by file extension
+GRID_SAVE_OPTIONS = {
+    ".jpeg": {
+        "Q": config.get("GRID_JPEG_QUALITY", 85),
+        "strip": True,
+    },
+    ".webp": {"Q": config.get("GRID_WEBP_QUALITY", 80), "strip": True},
+}
+GRID_FETCH_CONCURRENCY = config.get("GRID_FETCH_CONCURRENCY", 4)
+# Images larger than this are written to a temp file instead of kept in memory
+GRID_SPILL_BYTES = config.get("GRID_SPILL_BYTES", 8 * 1024 * 1024)
+SPILL_CHUNK_BYTES = 64 * 1024
+
+grid_encode_time = Histogram(
+    "instafix_grid_encode_seconds",
+    "Time to decode, compose and encode a grid (libvips runs all of it "
+    "while encoding)",
+    ("format",),
+)
+grid_output_bytes = Histogram(
+    "instafix_grid_output_bytes",
+    "Size of the generated grids",
+    ("format",),
+    buckets=(50_000, 100_000, 250_000, 500_000, 1_000_000, 2_000_000, 4_000_000),
+)
+
+grid_pool = RenderPool(
+    kind=config.get("GRID_POOL", "thread"),
+    workers=config.get("GRID_POOL_WORKERS", 2),
+    max_queue=config.get("GRID_POOL_MAX_QUEUE", 8),
+    memory_budget=config.get("GRID_POOL_MEMORY_BUDGET", 512 * 1024 * 1024),
+)
+
+
+def jpeg_dimensions(data: bytes):
+    """Read (width, height) from the SOFn segment of an in-memory JPEG."""
+    # Skip the first two bytes (JPEG SOI marker)
+    pos = 2
+    size = len(data)
+
+    while True:
+        # EOF check
+        if pos + 2 > size:
+            raise ValueError("Invalid JPEG file or dimensions not found")
+
+        # Check if we've reached a Start Of Frame marker (SOFn)
+        # SOF0 (0xFFC0), SOF1 (0xFFC1), SOF2 (0xFFC2), etc.
+        marker_code = (data[pos] << 8) + data[pos + 1]
+        pos += 2
+        is_sof = (
+            (marker_code >= 0xFFC0 and marker_code <= 0xFFC3)
+            or (marker_code >= 0xFFC5 and marker_code <= 0xFFC7)
+            or (marker_code >= 0xFFC9 and marker_code <= 0xFFCB)
+            or (marker_code >= 0xFFCD and marker_code <= 0xFFCF)
+        )
+
+        if is_sof:
+            # Skip segment length and precision bytes
+            pos += 3
+            if pos + 4 > size:
+                raise ValueError("Invalid JPEG file or dimensions not found")
 
+            # Read height and width (big-endian)
+            height = (data[pos] << 8) + data[pos + 1]
+            width = (data[pos + 2] << 8) + data[pos + 3]
+            return width, height
 
-def dijkstra(graph, start, end):
-    heap = [(0, start, [])]  # (cost, current_node, path)
-    visited = set()
+        # Length includes the 2 bytes for the length field itself
+        if pos + 2 > size:
+            raise ValueError("Invalid JPEG file or dimensions not found")
+        length = (data[pos] << 8) + data[pos + 1]
 
-    while heap:
-        cost, node, path = heapq.heappop(heap)
-        if node in visited:
-            continue
-        visited.add(node)
-        path = path + [node]
-        if node == end:
-            return path
-        for neighbor, weight in graph.get(node, []):
-            if neighbor not in visited:
-                heapq.heappush(heap, (cost + weight, neighbor, path))
-    return []
+        # Skip to the next marker
+        pos += length
 
 
 def get_jpeg_dimensions(file_path):
     with open(file_path, "rb") as file:
-        # Skip the first two bytes (JPEG SOI marker)
-        file.seek(2)
-
-        while True:
-            # Read marker
-            marker = file.read(2)
-
-            # EOF check
-            if len(marker) < 2:
-                raise ValueError("Invalid JPEG file or dimensions not found")
-
-            # Check if we've reached a Start Of Frame marker (SOFn)
-            # SOF0 (0xFFC0), SOF1 (0xFFC1), SOF2 (0xFFC2), etc.
-            marker_code = (marker[0] << 8) + marker[1]
-            is_sof = (
-                (marker_code >= 0xFFC0 and marker_code <= 0xFFC3)
-                or (marker_code >= 0xFFC5 and marker_code <= 0xFFC7)
-                or (marker_code >= 0xFFC9 and marker_code <= 0xFFCB)
-                or (marker_code >= 0xFFCD and marker_code <= 0xFFCF)
-            )
-
-            if is_sof:
-                # Skip segment length and precision bytes
-                file.seek(3, 1)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return jpeg_dimensions(data)  # type: ignore[arg-type]
 
-                # Read height and width (big-endian)
-                height_bytes = file.read(2)
-                width_bytes = file.read(2)
 
-                height = (height_bytes[0] << 8) + height_bytes[1]
-                width = (width_bytes[0] << 8) + width_bytes[1]
+class GridPlan(NamedTuple):
+    width: int
+    height: int
+    # (start, end, height): images[start:end] scaled to `height`
+    rows: list[tuple[int, int, int]]
 
-                return width, height
-            else:
-                # Skip to the next marker
-                # First, get segment length
-                length_bytes = file.read(2)
-                if len(length_bytes) < 2:
-                    raise ValueError("Invalid JPEG file or dimensions not found")
 
-                # Length includes the 2 bytes for the length field itself
-                length = (length_bytes[0] << 8) + length_bytes[1] - 2
+def plan_grid(
+    dims: Sequence[tuple[int, int]], max_pixels: int = GRID_MAX_PIXELS
+) -> GridPlan | None:
+    """
+    Lay out images of the given (width, height) in justified rows (see
+    `partition_rows`), then scale the whole grid down to at most
+    `max_pixels` (see `cap_plan`). Only the dimensions are needed, so this
+    can run before any image is downloaded. Returns None if a dimension is
+    unknown (0).
+    """
+    plan = partition_rows(dims)
+    if plan is None:
+        return None
+    return cap_plan(plan, max_pixels)
 
-                # Skip to the next marker
-                file.seek(length, 1)
 
+def partition_rows(dims: Sequence[tuple[int, int]]) -> GridPlan | None:
+    """
+    Split images of the given (width, height) in justified rows of up to
+    MAX_ROW_IMAGES, keeping row heights as close to MAX_ROW_HEIGHT as
+    possible, at full size. Returns None if a dimension is unknown (0).
+    """
+    if not dims or any(w <= 0 or h <= 0 for w, h in dims):
+        return None
+    n = len(dims)
+    # Canvas width ~ average image width × a factor (averaged over n + 1,
+    # as the graph based layout this replaces counted its end node)
+    canvas_w = int(sum(w for w, _ in dims) / (n + 1) * 1.5)
+    ratios = [w / h for w, h in dims]
+
+    # best[j]: lowest cost of laying out the first j images, the last row
+    # of which starts at image start[j]
+    best = [0.0] + [math.inf] * n
+    start = [0] * (n + 1)
+    for j in range(1, n + 1):
+        ratio_sum = 0.0
+        for i in range(j - 1, max(j - MAX_ROW_IMAGES, 0) - 1, -1):
+            ratio_sum += ratios[i]
+            cost = best[i] + (MAX_ROW_HEIGHT - canvas_w / ratio_sum) ** 2
+            if cost < best[j]:
+                best[j] = cost
+                start[j] = i
+
+    rows = []
+    j = n
+    while j > 0:
+        i = start[j]
+        rows.append((i, j, int(canvas_w / sum(ratios[i:j]))))
+        j = i
+    rows.reverse()
+    return GridPlan(canvas_w, sum(row[2] for row in rows), rows)
+
+
+def cap_plan(plan: GridPlan, max_pixels: int = GRID_MAX_PIXELS) -> GridPlan:
+    """
+    Scale `plan` down to at most `max_pixels`, and GRID_MAX_SIDE on either
+    side; smaller plans are returned as they are.
+    """
+    scale = min(
+        1.0,
+        math.sqrt(max_pixels / (plan.width * plan.height)),
+        GRID_MAX_SIDE / plan.width,
+        GRID_MAX_SIDE / plan.height,
+    )
+    if scale >= 1.0:
+        return plan
+    rows = [(i, j, max(1, int(row_h * scale))) for i, j, row_h in plan.rows]
+    return GridPlan(
+        max(1, int(plan.width * scale)), sum(row[2] for row in rows), rows
+    )
 
-def get_height(images_wh, canvas_width):
-    """Calculate the height (in pixels) of a row that fits canvas_width."""
-    # same logic as before: sum of (w/h) ratios
-    ratio_sum = sum(w / h for w, h in images_wh)
-    return canvas_width / ratio_sum
 
+class GridResult(NamedTuple):
+    path: str
+    width: int
+    height: int
+    # bytes written, and seconds spent writing them
+    size: int
+    encode_time: float
 
-def cost_fn(images_wh, i, j, canvas_width):
-    """Calculate cost of breaking images into a row."""
-    row_height = get_height(images_wh[i:j], canvas_width)
-    return (MAX_ROW_HEIGHT - row_height) ** 2
 
+def load_image(source: bytes | str, **options) -> "pyvips.Image":
+    import pyvips
 
-def create_graph(images_wh, start, canvas_width):
-    """Create graph nodes with costs based on image layout."""
-    results = {}
-    for i in range(start + 1, min(start + 4, len(images_wh))):
-        results[i] = cost_fn(images_wh, start, i, canvas_width)
-    return results
+    if isinstance(source, bytes):
+        return pyvips.Image.new_from_buffer(
+            source, "", access="sequential", **options
+        )
+    return pyvips.Image.new_from_file(source, access="sequential", **options)
 
 
-def generate_grid(image_paths: List[str], out_fname: str) -> Optional[str]:
+def load_tile(source: bytes | str, height: int) -> "pyvips.Image":
     """
-    Given a list of file paths, lay them out in an optimal
-    multi-row “justified” grid and write the result to out_fname.
-
-    Returns out_fname on success, None on failure.
+    Decode an image scaled to `height`. JPEGs are shrunk while decoding,
+    by the largest power of two (up to 8) that still leaves a downscale, so
+    the full-size pixels are never decoded; `resize` does the rest.
     """
-    # 1) Load metadata
-    im_meta = []
-    for path in image_paths:
-        img_width, img_height = get_jpeg_dimensions(path)
-        im_meta.append((img_width, img_height))
-    # sentinel to mark the "end" node
-    im_meta.append((0, 0))
-
-    # 2) Choose canvas width ~ average image width × a factor
-    avg_w = sum(w for w, h in im_meta) / len(im_meta)
-    canvas_w = int(avg_w * 1.5)
-
-    # 3) Build graph of breakpoints with costs
-    graph = defaultdict(list)
-    n = len(im_meta) - 1  # last index is the sentinel
-    for i in range(n):
-        for j, cost in create_graph(im_meta, i, canvas_w).items():
-            graph[i].append((j, cost))
-
-    # 4) Shortest‐path from 0 → n
-    path = dijkstra(graph, 0, n)
+    image = load_image(source)
+    shrink = 1
+    while shrink < 8 and image.height >= height * shrink * 2:
+        shrink *= 2
+    if shrink > 1 and image.get("vips-loader").startswith("jpegload"):
+        image = load_image(source, shrink=shrink)
+    image = image.resize(height / image.height)
+    if image.hasalpha():
+        image = image.flatten()
+    # Tiles are joined as 8-bit sRGB: convert grey, CMYK, 16-bit, ...
+    if image.interpretation != "srgb" or image.bands < 3:
+        image = image.colourspace("srgb")
+    return image
+
+
+def join_all(images: List["pyvips.Image"], direction: str) -> "pyvips.Image":
+    """Join images pairwise, keeping the chain of operations shallow."""
+    while len(images) > 1:
+        pairs = [images[i : i + 2] for i in range(0, len(images), 2)]
+        images = [
+            pair[0].join(pair[1], direction) if len(pair) == 2 else pair[0]
+            for pair in pairs
+        ]
+    return images[0]
+
+
+def image_dimensions(source: bytes | str):
+    if isinstance(source, bytes):
+        return jpeg_dimensions(source)
+    return get_jpeg_dimensions(source)
+
+
+def generate_grid(
+    images: List[bytes | str], out_fname: str, plan: GridPlan
+) -> Optional[GridResult]:
+    """
+    Given a list of images (in-memory JPEG bytes or file paths), compose
+    them in the rows of `plan` (see `plan_grid`) and write the result to
+    out_fname, as JPEG or WebP depending on its extension.
 
-    # 5) Compute each row height and total canvas height
-    row_heights = []
-    total_h = 0
-    for u, v in zip(path, path[1:]):
-        row_h = int(get_height(im_meta[u:v], canvas_w))
-        row_heights.append(row_h)
-        total_h += row_h
+    Returns what was written on success, None on failure.
+    """
+    # 1) Decode each row's images at their row height and join them.
+    # Rounding can leave a row a pixel or two off the canvas width, the
+    # gap is filled with black.
+    rows = []
+    for u, v, row_h in plan.rows:
+        tiles = [load_tile(images[idx], row_h) for idx in range(u, v)]
+        row = join_all(tiles, "horizontal")
+        rows.append(row.gravity("north-west", plan.width, row_h))
+
+    # 2) Stack the rows
+    canvas = join_all(rows, "vertical")
+
+    # 3) Save to a temporary name first, so the file is never served half-written
+    root, ext = os.path.splitext(out_fname)
+    tmp_fname = f"{root}.{os.getpid()}.tmp{ext}"
+    start = time.perf_counter()
+    try:
+        canvas.write_to_file(tmp_fname, **GRID_SAVE_OPTIONS.get(ext, {}))
+        size = os.path.getsize(tmp_fname)
+        os.replace(tmp_fname, out_fname)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    elapsed = time.perf_counter() - start
+    return GridResult(out_fname, canvas.width, canvas.height, size, elapsed)
+
+
+async def fetch_image(
+    session: HTTPSession, url: str, limit: asyncio.Semaphore
+) -> bytes | str:
+    """
+    Download an image. Past GRID_SPILL_BYTES (by Content-Length, or once
+    that much has arrived) the body is streamed to a temp file instead of
+    kept in memory, and its path is returned.
+    """
+    async with limit, session.http_get_stream(url) as response:
+        length = response.content_length
+        if length is not None and length <= GRID_SPILL_BYTES:
+            return await response.read()
+
+        chunks: List[bytes] = []
+        received = 0
+        spill = None
+        try:
+            async for chunk in response.content.iter_chunked(SPILL_CHUNK_BYTES):
+                if spill is not None:
+                    spill.write(chunk)
+                    continue
+                chunks.append(chunk)
+                received += len(chunk)
+                if received > GRID_SPILL_BYTES or length is not None:
+                    spill = tempfile.NamedTemporaryFile(suffix=".jpeg", delete=False)
+                    spill.writelines(chunks)
+                    chunks = []
+        except BaseException:
+            if spill is not None:
+                spill.close()
+                os.remove(spill.name)
+            raise
+    if spill is None:
+        return b"".join(chunks)
+    spill.close()
+    return spill.name
+
+
+def grid_memory_estimate(images: List[bytes | str], plan: GridPlan) -> int:
+    """
+    Rough peak memory of generate_grid: encoded inputs plus the output
+    pixels, which is about what the shrunk images add up to.
+    """
+    total = plan.width * plan.height * 3
+    for image in images:
+        if isinstance(image, bytes):
+            total += len(image)
+    return total
 
-    # 6) Create a black RGB canvas
-    # black() yields 1‐band; bandjoin -> 3 bands (R=G=B=0)
-    canvas = pyvips.Image.black(canvas_w, total_h).bandjoin(
-        [pyvips.Image.black(canvas_w, total_h)] * 2
-    )
 
-    # 7) Composite each row of images
-    y_offset = 0
-    for (u, v), row_h in zip(zip(path, path[1:]), row_heights):
-        x_offset = 0
-        for idx in range(u, v):
-            img = pyvips.Image.new_from_file(image_paths[idx], access="sequential")
-            # scale factor so height -> row_h
-            scale = row_h / img.height
-            img_resized = img.resize(scale)
-            # insert into canvas at (x_offset, y_offset)
-            canvas = canvas.insert(img_resized, x_offset, y_offset)
-            x_offset += img_resized.width
-        y_offset += row_h
-
-    # 8) Save
-    canvas.write_to_file(out_fname)
-    return out_fname
-
-
-async def grid_from_urls(urls: List[str], out_fname: str) -> Optional[str]:
-    """Generate a grid image based on the best row layout."""
-    images = []
-    async with aiohttp.ClientSession() as session:
-        for url in urls:
-            async with session.get(url) as response:
-                with tempfile.NamedTemporaryFile(suffix=".jpeg", delete=False) as f:
-                    f.write(await response.read())
-                    images.append(f.name)
+async def grid_from_urls(
+    urls: List[str], out_fname: str, plan: GridPlan | None = None
+) -> Optional[GridResult]:
+    """
+    Generate a grid image based on the best row layout. `plan` comes from
+    the scraped dimensions; without one (or if it does not cover every
+    image) it is computed from the downloaded images' headers.
 
-    try:
-        return generate_grid(images, out_fname)
-    except Exception as e:
-        raise e
-    finally:
-        for f in images:
-            os.remove(f)
+    Raises PoolSaturatedError if the render pool cannot take the job.
+    """
+    with grid_pool.acquire() as slot:
+        limit = asyncio.Semaphore(GRID_FETCH_CONCURRENCY)
+        async with HTTPSession() as session:
+            results = await asyncio.gather(
+                *(fetch_image(session, url, limit) for url in urls),
+                return_exceptions=True,
+            )
+        images = [r for r in results if not isinstance(r, BaseException)]
+
+        try:
+            for r in results:
+                if isinstance(r, BaseException):
+                    raise r
+            if plan is None or plan.rows[-1][1] != len(images):
+                plan = plan_grid([image_dimensions(image) for image in images])
+                if plan is None:
+                    return None
+            result = await slot.run(
+                generate_grid,
+                images,
+                out_fname,
+                plan,
+                memory=grid_memory_estimate(images, plan),
+            )
+        finally:
+            for image in images:
+                if isinstance(image, str):
+                    os.remove(image)
+
+    if result is not None:
+        fmt = os.path.splitext(out_fname)[1].lstrip(".")
+        grid_encode_time.observe(result.encode_time, fmt)
+        grid_output_bytes.observe(result.size, fmt)
+        logger.debug(
+            f"Grid {out_fname}: {result.width}x{result.height}, {result.size} bytes "
+            f"encoded in {result.encode_time * 1000:.1f}ms"
+        )
+    return result
+
+
+async def grid_pool_ctx(app):
+    """
+    aiohttp cleanup context loading pyvips in the background, and shutting
+    the grid render pool down on exit.
+    """
+    loop = asyncio.get_running_loop()
+    warmup = loop.run_in_executor(None, importlib.import_module, "pyvips")
+    yield
+    await asyncio.gather(warmup, return_exceptions=True)
+    await asyncio.get_running_loop().run_in_executor(None, grid_pool.shutdown)
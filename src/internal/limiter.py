@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import time
+from typing import Any, AsyncIterator
+
+import aiohttp
+
+from internal.retry import FailFastError
+from internal.waitqueue import WaitQueue
+
+
+class LimitExceededError(FailFastError):
+    """Raised when a request is refused because the limiter queue is full."""
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, bursting to `burst`."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        # Take the token now and sleep off the debt, so concurrent callers
+        # queue up behind each other instead of waking all at once
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class LimiterSlot:
+    """
+    A held unit of concurrency. Latency counts from `start()`, so waits
+    that are not upstream's doing (e.g. for a proxy) can be left out.
+    """
+
+    __slots__ = ("started",)
+
+    def __init__(self):
+        self.started = time.monotonic()
+
+    def start(self) -> None:
+        self.started = time.monotonic()
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that adapts to how upstream is coping (AIMD).
+
+    Each success while the limit is actually in use raises it by
+    1 / limit, so roughly by one per round trip. A 429 / 503, a timeout,
+    or a response slower than `latency_target` cuts it by `backoff`, at
+    most once per `cooldown` seconds so that a single burst of errors
+    counts as one signal.
+
+    Callers above the limit wait in a FIFO queue; when `max_queue` are
+    already waiting, LimitExceededError is raised instead. An optional
+    token bucket additionally caps the request rate.
+    """
+
+    def __init__(
+        self,
+        initial: int = 20,
+        min_limit: int = 2,
+        max_limit: int = 200,
+        max_queue: int = 200,
+        latency_target: float = 3.0,
+        backoff: float = 0.7,
+        cooldown: float = 1.0,
+        qps: float = 0,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.bucket = TokenBucket(qps) if qps > 0 else None
+
+        self._in_flight = 0
+        self._queue: WaitQueue[None, bool] = WaitQueue()
+        self._last_decrease = 0.0
+        # Counters, for stats
+        self.rejected = 0
+        self.decreases = 0
+
+    def _take(self, _key: None) -> bool | None:
+        if self._in_flight >= int(self.limit):
+            return None
+        self._in_flight += 1
+        return True
+
+    def _wake(self) -> None:
+        self._queue.wake(self._take)
+
+    async def _acquire(self) -> None:
+        if not self._queue and self._take(None):
+            return
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise LimitExceededError(
+                f"{len(self._queue)} requests queued, limit {int(self.limit)}"
+            )
+        await self._queue.wait(None, lambda _: self._release())
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._wake()
+
+    def _on_success(self, elapsed: float) -> None:
+        if elapsed > self.latency_target:
+            self._on_overload()
+        elif self._in_flight >= self.limit / 2:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+    def _on_overload(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[LimiterSlot]:
+        """
+        Hold one unit of concurrency for a request. The limit is adjusted
+        from how the block exits; cancellation counts for nothing. The
+        rate limit token is taken before queueing for the slot, so
+        nobody sleeps on the token bucket while holding one.
+        """
+        if self.bucket is not None:
+            await self.bucket.acquire()
+        await self._acquire()
+        try:
+            slot = LimiterSlot()
+            try:
+                yield slot
+            except aiohttp.ClientResponseError as e:
+                if e.status in (429, 503):
+                    self._on_overload()
+                raise
+            except asyncio.TimeoutError:
+                self._on_overload()
+                raise
+            else:
+                self._on_success(time.monotonic() - slot.started)
+        finally:
+            self._release()
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self._in_flight,
+            "queue": len(self._queue),
+            "rejected": self.rejected,
+            "decreases": self.decreases,
+        }
@@ -0,0 +1,167 @@
+"""
+Minimal Prometheus text-format metrics.
+
+Counters and histograms keep one small list per label combination, so
+recording is a dict lookup plus an add (and a bisect for histograms),
+without allocating once a label combination has been seen. Values that
+already live elsewhere (cache counters, pool stats, ...) are not copied
+into metrics; a collector reads them when /metrics is scraped.
+"""
+
+import bisect
+import time
+from typing import Callable, Iterable
+
+from aiohttp import web
+
+# Seconds, for request and upstream latencies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# A sample: (label values, value)
+Sample = tuple[tuple[str, ...], float]
+
+_metrics: list["Counter | Histogram"] = []
+_collectors: list[Callable[[], Iterable[str]]] = []
+# Rendered label pairs added to every sample, see `set_worker`
+_common_labels: list[str] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = _common_labels + [
+        f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def family(
+    name: str, kind: str, help: str, labels: tuple[str, ...], samples: Iterable[Sample]
+) -> str:
+    """Render one metric family, for collectors."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for values, value in samples:
+        lines.append(f"{name}{_labels(labels, values)} {_format(value)}")
+    return "\n".join(lines)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple[str, ...], list[float]] = {}
+        _metrics.append(self)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        value = self._values.get(labels)
+        if value is None:
+            value = self._values[labels] = [0]
+        value[0] += amount
+
+    def render(self) -> str:
+        return family(
+            self.name,
+            "counter",
+            self.help,
+            self.labels,
+            ((labels, value[0]) for labels, value in self._values.items()),
+        )
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # per label values: one count per bucket, +Inf, then sum
+        self._values: dict[tuple[str, ...], list[float]] = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, counts in self._values.items():
+            labels = _labels(self.labels, values)
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                bucket_labels = _labels(self.labels, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {_format(total)}")
+            lines.append(f"{self.name}_sum{labels} {_format(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {_format(total)}")
+        return "\n".join(lines)
+
+
+def collector(fn: Callable[[], Iterable[str]]) -> Callable[[], Iterable[str]]:
+    """Register `fn`, called on every scrape to render families with `family`."""
+    _collectors.append(fn)
+    return fn
+
+
+def set_worker(index: int) -> None:
+    """
+    Label every sample with the worker process rendering it. Each worker
+    counts on its own and a scrape reaches any one of them, so without it
+    counters would seem to jump back and forth between scrapes.
+    """
+    _common_labels[:] = [f'worker="{index}"']
+
+
+def render_metrics() -> str:
+    parts = [metric.render() for metric in _metrics]
+    for fn in _collectors:
+        parts.extend(fn())
+    return "\n".join(parts) + "\n"
+
+
+http_requests = Counter(
+    "instafix_http_requests_total",
+    "HTTP requests by route and status",
+    ("route", "status"),
+)
+http_latency = Histogram(
+    "instafix_http_request_seconds", "HTTP request latency by route", ("route",)
+)
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        match_info = request.match_info
+        if match_info.http_exception is not None:
+            route = "unmatched"
+        else:
+            route = getattr(match_info.handler, "__name__", "unknown")
+        http_requests.inc(route, str(status))
+        http_latency.observe(time.perf_counter() - started, route)
@@ -0,0 +1,126 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+RT = TypeVar("RT")
+
+
+class PoolSaturatedError(Exception):
+    """Raised when a render job is refused by admission control."""
+
+
+class RenderSlot:
+    """
+    An admitted job in a `RenderPool`.
+
+    Holding a slot counts towards the pool's queue depth from the moment
+    it is acquired (so callers can be refused before doing any I/O) until
+    the context manager exits.
+    """
+
+    def __init__(self, pool: "RenderPool"):
+        self._pool = pool
+        self._memory = 0
+
+    def __enter__(self) -> "RenderSlot":
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback) -> None:
+        self._pool._release(self._memory)
+        self._memory = 0
+
+    async def run(
+        self, fn: Callable[..., RT], *args: Any, memory: int = 0
+    ) -> RT:
+        """
+        Run `fn(*args)` on the pool's executor.
+
+        `memory` is the estimated peak memory of the job in bytes. It is
+        charged against the pool's memory budget for the lifetime of the
+        slot; if it does not fit, PoolSaturatedError is raised.
+        """
+        self._pool._charge(memory)
+        self._memory += memory
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool.executor, fn, *args)
+
+
+class RenderPool:
+    """
+    Bounded thread or process pool for CPU heavy work (e.g. pyvips).
+
+    Admission is controlled by a maximum number of queued + running jobs
+    and a memory budget, so that a burst of work is refused quickly
+    instead of piling up behind the workers.
+    """
+
+    def __init__(
+        self,
+        kind: str = "thread",
+        workers: int = 2,
+        max_queue: int = 8,
+        memory_budget: int = 512 * 1024 * 1024,
+    ):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown pool kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.memory_budget = memory_budget
+
+        self._executor: Executor | None = None
+        self._pending = 0
+        self._memory = 0
+        self.rejected = 0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn, not fork: forking a process with libvips and the
+                # event loop already running is not safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="render"
+                )
+        return self._executor
+
+    def acquire(self) -> RenderSlot:
+        """Reserve a queue slot, raising PoolSaturatedError if the queue is full."""
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise PoolSaturatedError(f"{self._pending} jobs already queued")
+        self._pending += 1
+        return RenderSlot(self)
+
+    def _charge(self, memory: int) -> None:
+        # Always admit a job when nothing else is running, even if it is
+        # larger than the whole budget, so big posts are not starved forever
+        if self._memory > 0 and self._memory + memory > self.memory_budget:
+            self.rejected += 1
+            raise PoolSaturatedError(
+                f"memory budget exceeded ({self._memory + memory} bytes)"
+            )
+        self._memory += memory
+
+    def _release(self, memory: int) -> None:
+        self._pending -= 1
+        self._memory -= memory
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending": self._pending,
+            "memory": self._memory,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,193 @@
+import asyncio
+import random
+import time
+from typing import Any, Callable, Coroutine, Tuple, Type, TypeVar
+
+RT = TypeVar("RT")
+
+
+class FailFastError(Exception):
+    """
+    A call refused locally, without reaching upstream. It is neither
+    retried nor counted against the circuit breaker.
+    """
+
+
+class CircuitOpenError(FailFastError):
+    """Raised instead of calling an endpoint whose circuit breaker is open."""
+
+    def __init__(self, name: str):
+        super().__init__(f"circuit '{name}' is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls fail fast for `reset_timeout` seconds. It then goes half-open:
+    up to `half_open_max` probe calls are let through, and the first
+    success closes the circuit again while a failure re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        half_open_max: int = 1,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._state = self.CLOSED
+        # Counters, for stats
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if (
+            self._state == self.OPEN
+            and time.monotonic() - self._opened_at >= self.reset_timeout
+        ):
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls are being refused outright."""
+        state = self.state
+        return state == self.OPEN or (
+            state == self.HALF_OPEN and self._probes >= self.half_open_max
+        )
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._probes < self.half_open_max:
+            self._probes += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._state = self.CLOSED
+
+    def release(self) -> None:
+        """
+        End an allowed call without a verdict (cancelled, or refused
+        locally), giving its half-open probe slot back.
+        """
+        if self._state == self.HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                self.opened += 1
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self._failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+class RetryPolicy:
+    """
+    Retries an async call with exponential backoff and full jitter, a
+    timeout per attempt, and an optional circuit breaker.
+
+    Exceptions listed in `give_up_on`, or for which `give_up_if` returns
+    True, are a valid answer from upstream (e.g. RestrictedError, a 404):
+    they are raised straight away and count as a success for the breaker.
+    A cancelled attempt, or one refused locally (FailFastError), counts
+    for nothing.
+    """
+
+    def __init__(
+        self,
+        attempts: int = 3,
+        base_delay: float = 0.25,
+        max_delay: float = 4.0,
+        timeout: float = 10.0,
+        give_up_on: Tuple[Type[BaseException], ...] = (),
+        give_up_if: Callable[[BaseException], bool] | None = None,
+    ):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.give_up_on = give_up_on
+        self.give_up_if = give_up_if
+
+    def backoff(self, attempt: int) -> float:
+        """Sleep before retry number `attempt` (0 based), with full jitter."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def run(
+        self,
+        breaker: CircuitBreaker | None,
+        fn: Callable[..., Coroutine[Any, Any, RT]],
+        *args: Any,
+        **kwargs: Any,
+    ) -> RT:
+        """
+        Call `fn(*args, **kwargs)` until it succeeds or attempts run out,
+        re-raising the last error. Raises CircuitOpenError without calling
+        `fn` while the breaker refuses calls.
+        """
+        for attempt in range(self.attempts):
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(breaker.name)
+            recorded = False
+            try:
+                result = await asyncio.wait_for(fn(*args, **kwargs), self.timeout)
+            except FailFastError:
+                raise
+            except self.give_up_on:
+                if breaker is not None:
+                    breaker.record_success()
+                    recorded = True
+                raise
+            except Exception as e:
+                if self.give_up_if is not None and self.give_up_if(e):
+                    if breaker is not None:
+                        breaker.record_success()
+                        recorded = True
+                    raise
+                if breaker is not None:
+                    breaker.record_failure()
+                    recorded = True
+                if attempt == self.attempts - 1:
+                    raise
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                    recorded = True
+                return result
+            finally:
+                if breaker is not None and not recorded:
+                    breaker.release()
+            await asyncio.sleep(self.backoff(attempt))
+        raise AssertionError("unreachable")
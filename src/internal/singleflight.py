@@ -1,11 +1,21 @@
 import asyncio
-from typing import Any, Callable, Coroutine, Dict, Generic, TypeVar
+from typing import Any, Callable, Coroutine, Dict, Generic, Tuple, TypeVar
+
+from loguru import logger
 
 # Define generic type variables for Key and Return types
 KT = TypeVar("KT")
 RT = TypeVar("RT")
 
 
+class _Call(Generic[RT]):
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task[RT]"):
+        self.task = task
+        self.waiters = 0
+
+
 class Singleflight(Generic[KT, RT]):
     """
     Implements the singleflight pattern for async functions.
@@ -14,13 +24,28 @@ class Singleflight(Generic[KT, RT]):
     called only once, even if `do` is called multiple times concurrently
     with the same key. Concurrent callers for the same key will wait for
     the single execution to complete and share its result or exception.
+
+    asyncio runs everything on one thread and nothing here awaits while
+    touching the bookkeeping, so no lock is needed.
+
+    With `retain` > 0, a successful result is also kept for that many
+    seconds after the call finishes, and handed to callers arriving just
+    after it completed instead of calling `fn` again. Exceptions and None
+    results (nothing found, or a failed attempt) are never retained, so
+    the next caller tries again.
     """
 
-    def __init__(self):
-        # Stores the ongoing asyncio.Task for each key
-        self._calls: Dict[KT, asyncio.Task[RT]] = {}
-        # Lock to protect access to the _calls dictionary
-        self._lock = asyncio.Lock()
+    def __init__(self, retain: float = 0.0):
+        self.retain = retain
+        # Ongoing call for each key
+        self._calls: Dict[KT, _Call[RT]] = {}
+        # Retained results, key -> (expires at in loop time, result)
+        self._results: Dict[KT, Tuple[float, RT]] = {}
+
+        # Counters for `stats`
+        self.requests = 0
+        self.executions = 0
+        self.retained_hits = 0
 
     async def do(
         self,
@@ -32,13 +57,9 @@ class Singleflight(Generic[KT, RT]):
         """
         Executes the async function `fn` for the given `key`.
 
-        If another call with the same `key` is already in progress, this
-        call will wait for the ongoing call to complete and return its
-        result or raise its exception.
-
-        If no call is in progress for `key`, `fn(*args, **kwargs)` will be
-        executed. Its result or exception will be returned to this caller
-        and any other concurrent callers for the same `key`.
+        If another call with the same `key` is already in progress (or
+        finished less than `retain` seconds ago), this call will share its
+        result or exception instead of calling `fn`.
 
         Args:
             key: The key identifying the operation.
@@ -52,89 +73,96 @@ class Singleflight(Generic[KT, RT]):
         Raises:
             The exception raised by `fn(*args, **kwargs)`.
         """
-        task: asyncio.Task[RT] | None = None
-        is_owner = False
-
-        async with self._lock:
-            if key in self._calls:
-                # Another call is already in flight, get its task
-                task = self._calls[key]
-            else:
-                # No call in flight, we are the owner, create a new task
-                is_owner = True
-
-                # We wrap the actual function call and the cleanup logic
-                # in a new coroutine managed by this task.
-                async def task_wrapper():
-                    try:
-                        return await fn(*args, **kwargs)
-                    finally:
-                        # --- Cleanup ---
-                        # This cleanup runs regardless of whether fn succeeded or failed.
-                        # We need the lock again to safely modify the dictionary.
-                        async with self._lock:
-                            # Delete the entry *only if* it's still our task.
-                            # This guards against rare race conditions where the key
-                            # might have been quickly forgotten and reused.
-                            if self._calls.get(key) is task:
-                                del self._calls[key]
-                        # --- End Cleanup ---
-
-                # Create the task but don't await it inside the lock
-                task = asyncio.create_task(task_wrapper())
-                self._calls[key] = task
-
-        # Assert task is not None (should always be assigned in the lock)
-        assert task is not None, "Task should have been assigned"
-
-        # Wait for the task to complete and get the result/exception.
-        # This happens *outside* the initial lock acquisition, allowing
-        # other concurrent calls for *different* keys to proceed.
-        # If multiple callers wait on the *same* task, asyncio handles that efficiently.
+        self.requests += 1
+
+        if self._results:
+            retained = self._results.get(key)
+            if retained is not None:
+                if retained[0] > asyncio.get_running_loop().time():
+                    self.retained_hits += 1
+                    return retained[1]
+                del self._results[key]
+
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(fn(*args, **kwargs)))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._done(key, call))
+            self.executions += 1
+
+        call.waiters += 1
         try:
-            # `await task` will return the result or raise the exception
-            return await task
-        except asyncio.CancelledError:
-            # If the task was cancelled, propagate the cancellation.
-            # If we were the owner, the cleanup might have already run or
-            # will run shortly. If we were a waiter, the owner handles cleanup.
-            print(f"Call for key '{key}' was cancelled.")
-            raise
-        except Exception as e:
-            # If the underlying function `fn` raised an exception,
-            # `await task` re-raises it here.
-            # The cleanup in task_wrapper ensures the state is cleared.
-            # No special handling needed here unless you want to log.
-            # print(f"Call for key '{key}' failed: {e}") # Optional logging
-            raise  # Re-raise the original exception
+            return await call.task
+        finally:
+            call.waiters -= 1
+
+    def _done(self, key: KT, call: _Call[RT]) -> None:
+        # Delete the entry *only if* it's still our call, the key might
+        # have been forgotten and reused meanwhile
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+        task = call.task
+        # exception() also marks it as retrieved, in case every caller left
+        if task.cancelled() or task.exception() is not None:
+            return
+        if task.result() is None:
+            return
+        if self.retain:
+            loop = asyncio.get_running_loop()
+            entry = (loop.time() + self.retain, task.result())
+            self._results[key] = entry
+            loop.call_later(self.retain, self._expire, key, entry)
+
+    def _expire(self, key: KT, entry: Tuple[float, RT]) -> None:
+        if self._results.get(key) is entry:
+            del self._results[key]
+
+    def waiters(self, key: KT) -> int:
+        """Number of callers currently waiting on `key`."""
+        call = self._calls.get(key)
+        return call.waiters if call else 0
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        waiters = [call.waiters for call in self._calls.values()]
+        return {
+            "in_flight": len(self._calls),
+            "waiters": sum(waiters),
+            "max_waiters": max(waiters, default=0),
+            "retained": len(self._results),
+            "requests": self.requests,
+            "executions": self.executions,
+            "retained_hits": self.retained_hits,
+            # share of requests that did not call fn themselves
+            "dedupe_ratio": (
+                1 - self.executions / self.requests if self.requests else 0.0
+            ),
+        }
 
     async def forget(self, key: KT) -> bool:
         """
-        Removes a key from the internal map. If a call is in progress for this
-        key, it is cancelled.
+        Removes a key from the internal map, including a retained result.
+        If a call is in progress for this key, it is cancelled.
 
         Returns:
             True if the key was found and removed/cancelled, False otherwise.
         """
-        task_to_cancel: asyncio.Task[RT] | None = None
-        removed = False
-        async with self._lock:
-            if key in self._calls:
-                task_to_cancel = self._calls.pop(key)
-                removed = True
-
-        if task_to_cancel:
-            # Cancel the task outside the lock
-            task_to_cancel.cancel()
-            try:
-                # Give the task a chance to handle cancellation and cleanup
-                await asyncio.wait_for(task_to_cancel, timeout=1.0)
-            except asyncio.CancelledError:
-                # Expected outcome
-                pass
-            except asyncio.TimeoutError:
-                print(f"Warning: Timeout waiting for cancelled task '{key}' to finish.")
-            except Exception:
-                # Ignore other exceptions during forced cleanup
-                pass
-        return removed
+        retained = self._results.pop(key, None)
+        call = self._calls.pop(key, None)
+        if call is None:
+            return retained is not None
+
+        call.task.cancel()
+        try:
+            # Give the task a chance to handle cancellation and cleanup
+            await asyncio.wait_for(call.task, timeout=1.0)
+        except asyncio.CancelledError:
+            # Expected outcome
+            pass
+        except asyncio.TimeoutError:
+            logger.debug(f"Timeout waiting for cancelled task '{key}' to finish")
+        except Exception:
+            # Ignore other exceptions during forced cleanup
+            pass
+        return True
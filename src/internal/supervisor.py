@@ -0,0 +1,208 @@
+"""
+Pre-spawned worker processes sharing one port with SO_REUSEPORT.
+
+The supervisor only starts, watches and restarts workers; it never
+serves requests. Workers are started with the "spawn" method, so each
+one imports the app (and opens its own cache handles) from scratch and
+nothing is shared through a fork.
+
+- Health: every worker writes a timestamp to a shared heartbeat value
+  from its event loop. A worker that exits, or whose heartbeat is older
+  than `timeout` (or that never sends one within `startup_timeout`), is
+  killed and started again, with a growing delay if it keeps crashing
+  right after starting.
+- SIGHUP: rolling restart. Each worker is replaced one at a time: the new
+  one is started next to the old one (the port is shared), and the old
+  one only gets SIGTERM, and drains its requests, once the new one is up.
+- SIGTERM / SIGINT: every worker gets SIGTERM, and is killed if it has
+  not exited after `shutdown_timeout`.
+
+What workers share is on disk: the LSM caches and the grid files, with
+worker 0 owning eviction and the grid index. Everything in memory is per
+worker: the L1 post cache, the response cache, singleflight, breakers,
+limiters and metrics. So a post refreshed by one worker stays stale in
+the others' memory until they look at the disk again, which they do
+before starting a refresh of their own, and metrics carry a `worker`
+label.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from typing import Any, Callable
+
+from loguru import logger
+
+# Workers crashing faster than this after starting are restarted with backoff
+MIN_UPTIME = 10
+MAX_RESTART_DELAY = 30
+
+
+class Worker:
+    def __init__(self, index: int, process: multiprocessing.Process, heartbeat):
+        self.index = index
+        self.process = process
+        self.heartbeat = heartbeat
+        self.started_at = time.monotonic()
+
+    @property
+    def ready(self) -> bool:
+        return self.heartbeat.value > 0
+
+    def healthy(self, timeout: float, startup_timeout: float) -> bool:
+        if not self.process.is_alive():
+            return False
+        if not self.ready:
+            return time.monotonic() - self.started_at < startup_timeout
+        return time.time() - self.heartbeat.value < timeout
+
+    def stop(self, timeout: float) -> None:
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning(f"Worker {self.index} did not stop in {timeout}s, killing it")
+            self.process.kill()
+            self.process.join()
+
+
+class Supervisor:
+    def __init__(
+        self,
+        target: Callable[..., Any],
+        workers: int,
+        args: tuple = (),
+        timeout: float = 30,
+        startup_timeout: float = 60,
+        shutdown_timeout: float = 30,
+    ):
+        """
+        `target(index, heartbeat, *args)` runs a worker; it must call
+        `heartbeat_ctx` (or otherwise update `heartbeat.value`) regularly.
+        """
+        self.target = target
+        self.count = workers
+        self.args = args
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.shutdown_timeout = shutdown_timeout
+
+        self._mp = multiprocessing.get_context("spawn")
+        self._workers: dict[int, Worker] = {}
+        self._crashes: dict[int, int] = {}
+        self._not_before: dict[int, float] = {}
+        self._stopping = False
+        self._reload = False
+
+    def _spawn(self, index: int) -> Worker:
+        heartbeat = self._mp.Value("d", 0.0, lock=False)
+        process = self._mp.Process(
+            target=self.target,
+            args=(index, heartbeat, *self.args),
+            name=f"worker-{index}",
+        )
+        process.start()
+        logger.info(f"Started worker {index} (pid {process.pid})")
+        return Worker(index, process, heartbeat)
+
+    def _check(self, index: int) -> None:
+        worker = self._workers.get(index)
+        if worker is not None:
+            if worker.healthy(self.timeout, self.startup_timeout):
+                if time.monotonic() - worker.started_at > MIN_UPTIME:
+                    self._crashes[index] = 0
+                return
+            if worker.process.is_alive():
+                logger.error(f"Worker {index} is not responding, killing it")
+                worker.process.kill()
+            worker.process.join()
+            logger.error(
+                f"Worker {index} (pid {worker.process.pid}) exited "
+                f"with code {worker.process.exitcode}"
+            )
+            del self._workers[index]
+            if time.monotonic() - worker.started_at < MIN_UPTIME:
+                self._crashes[index] = self._crashes.get(index, 0) + 1
+                delay = min(MAX_RESTART_DELAY, 2 ** self._crashes[index])
+                self._not_before[index] = time.monotonic() + delay
+                logger.warning(f"Worker {index} is crashing, restarting in {delay}s")
+
+        if time.monotonic() >= self._not_before.get(index, 0):
+            self._workers[index] = self._spawn(index)
+
+    def _rolling_restart(self) -> None:
+        logger.info("Rolling restart of all workers")
+        for index in range(self.count):
+            new = self._spawn(index)
+            deadline = time.monotonic() + self.startup_timeout
+            while not new.ready and new.process.is_alive():
+                if time.monotonic() > deadline or self._stopping:
+                    break
+                time.sleep(0.1)
+            if not new.ready:
+                logger.error(f"New worker {index} did not start, aborting restart")
+                new.stop(self.shutdown_timeout)
+                return
+
+            old = self._workers.get(index)
+            self._workers[index] = new
+            if old is not None:
+                old.stop(self.shutdown_timeout)
+        logger.info("Rolling restart done")
+
+    def _on_signal(self, signum, frame) -> None:
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stopping = True
+
+    def run(self) -> None:
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+
+        logger.info(f"Supervisor {os.getpid()} starting {self.count} workers")
+        for index in range(self.count):
+            self._workers[index] = self._spawn(index)
+
+        while not self._stopping:
+            time.sleep(0.5)
+            if self._reload:
+                self._reload = False
+                self._rolling_restart()
+            for index in range(self.count):
+                if not self._stopping:
+                    self._check(index)
+
+        logger.info("Stopping workers")
+        for worker in self._workers.values():
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self._workers.values():
+            worker.stop(self.shutdown_timeout)
+
+
+def heartbeat_ctx(heartbeat, interval: float = 1.0):
+    """
+    aiohttp cleanup context updating `heartbeat` from the event loop, so a
+    blocked loop shows up as a stale heartbeat. Also stops the worker if
+    the supervisor goes away.
+    """
+    parent = os.getppid()
+
+    async def ctx(app):
+        async def beat():
+            while True:
+                if os.getppid() != parent:
+                    logger.warning("Supervisor is gone, stopping worker")
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+                heartbeat.value = time.time()
+                await asyncio.sleep(interval)
+
+        task = asyncio.create_task(beat())
+        yield
+        task.cancel()
+
+    return ctx
@@ -0,0 +1,84 @@
+"""
+Per-request stage timings.
+
+`timing_middleware` gives every request a dict of stage -> seconds in a
+context variable, `span` adds to it, and the result is sent back as a
+Server-Timing header. Tasks started while handling a request inherit the
+context, so work done in the background for it (a scrape shared through
+singleflight, the hedged strategies) is still counted. Outside of a
+request `span` does nothing but one context variable lookup.
+"""
+
+import os
+import random
+import time
+from contextvars import ContextVar
+
+from aiohttp import web
+from loguru import logger
+
+from config import config
+
+# Requests slower than this are logged with their timings, sampled
+SLOW_REQUEST = config.get("SLOW_REQUEST_MS", 1000) / 1000
+SLOW_REQUEST_SAMPLE = config.get("SLOW_REQUEST_SAMPLE", 1.0)
+
+_spans: ContextVar[dict[str, float] | None] = ContextVar("spans", default=None)
+
+
+class span:
+    """Time the block as stage `name`; repeated stages add up."""
+
+    __slots__ = ("name", "spans", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> "span":
+        self.spans = _spans.get()
+        if self.spans is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback) -> None:
+        if self.spans is not None:
+            elapsed = time.perf_counter() - self.started
+            self.spans[self.name] = self.spans.get(self.name, 0.0) + elapsed
+
+
+def process_age() -> float:
+    """Seconds since this process started, interpreter startup included."""
+    try:
+        with open("/proc/self/stat") as f:
+            # starttime, the 22nd field, in clock ticks since boot
+            started = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return uptime - started / os.sysconf("SC_CLK_TCK")
+
+
+def server_timing(spans: dict[str, float], total: float) -> str:
+    entries = [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in spans.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+@web.middleware
+async def timing_middleware(request: web.Request, handler):
+    spans: dict[str, float] = {}
+    token = _spans.set(spans)
+    started = time.perf_counter()
+    try:
+        response = await handler(request)
+    finally:
+        _spans.reset(token)
+    total = time.perf_counter() - started
+
+    header = server_timing(spans, total)
+    response.headers["Server-Timing"] = header
+    if total >= SLOW_REQUEST and random.random() < SLOW_REQUEST_SAMPLE:
+        post_id = request.match_info.get("post_id", "-")
+        logger.warning(f"[{post_id}] Slow request {request.path}: {header}")
+    return response
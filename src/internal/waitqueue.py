@@ -0,0 +1,80 @@
+import asyncio
+import collections
+from typing import Callable, Generic, TypeVar
+
+KT = TypeVar("KT")
+RT = TypeVar("RT")
+
+
+class WaitQueue(Generic[KT, RT]):
+    """
+    Callers waiting for a limited resource, served in arrival order.
+
+    Each waiter has a key saying what it can use (e.g. a pinned proxy,
+    None for anything). `wake` hands freed resources straight to waiters,
+    one each, so a release never wakes callers that then race for it;
+    a waiter that gets one does not recheck.
+    """
+
+    def __init__(self):
+        self._waiters: collections.deque[
+            tuple[KT, asyncio.Future[RT]]
+        ] = collections.deque()
+        # Waiters per key, to stop `wake` early once no key can be served
+        self._keys: collections.Counter[KT] = collections.Counter()
+
+    def __len__(self) -> int:
+        return len(self._waiters)
+
+    def waiting(self, key: KT) -> int:
+        """Number of callers waiting with `key`."""
+        return self._keys[key]
+
+    async def wait(self, key: KT, give_back: Callable[[RT], None]) -> RT:
+        """
+        Wait to be handed a resource by `wake`. If cancelled right after
+        being handed one, it is passed to `give_back`.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (key, waiter)
+        self._waiters.append(entry)
+        self._keys[key] += 1
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                give_back(waiter.result())
+            else:
+                self._remove(entry)
+            raise
+
+    def _remove(self, entry: tuple[KT, asyncio.Future[RT]]) -> None:
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            self._keys[entry[0]] -= 1
+            if not self._keys[entry[0]]:
+                del self._keys[entry[0]]
+
+    def wake(self, take: Callable[[KT], RT | None]) -> None:
+        """
+        Hand resources to waiters in order: `take(key)` claims one for a
+        waiter with that key, or returns None when there is none for it,
+        and waiters with that key are then passed over rather than
+        holding up the others.
+        """
+        full = set()
+        for entry in list(self._waiters):
+            if len(full) == len(self._keys):
+                return
+            key, waiter = entry
+            if waiter.done():
+                self._remove(entry)
+                continue
+            if key in full:
+                continue
+            resource = take(key)
+            if resource is None:
+                full.add(key)
+                continue
+            self._remove(entry)
+            waiter.set_result(resource)
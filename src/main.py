@@ -1,6 +1,9 @@
+import asyncio
+import hmac
 import json
 import os
 import re
+import time
 import urllib.parse
 
 import aiohttp
@@ -8,12 +11,41 @@ import aiohttp.web_request
 from aiohttp import web
 from loguru import logger
 
-from cache import grid_cache_cb
+from cache import (
+    CACHE_OWNER,
+    cache_ctx,
+    grid_cache,
+    response_cache,
+)
 from config import config
-from internal.grid_layout import grid_from_urls
+from internal.grid_layout import (
+    GridPlan,
+    GridResult,
+    grid_from_urls,
+    grid_pool,
+    grid_pool_ctx,
+    plan_grid,
+)
+from internal.metrics import (
+    Counter,
+    collector,
+    family,
+    metrics_middleware,
+    render_metrics,
+    set_worker,
+)
+from internal.render_pool import PoolSaturatedError
 from internal.singleflight import Singleflight
-from scrapers import get_post
-from scrapers.data import RestrictedError, PostJSON, MediaJSON
+from internal.supervisor import Supervisor, heartbeat_ctx
+from internal.timing import process_age, span, timing_middleware
+from scrapers import get_post, get_post_versioned, scraper_sf, upstream_down
+from scrapers.data import (
+    MediaJSON,
+    Post,
+    PostJSON,
+    RestrictedError,
+    client_session_ctx,
+)
 from scrapers.share import resolve_share_id
 from templates.embed import render_embed
 from templates.error import render_error
@@ -23,6 +55,11 @@ def RedirectResponse(url):
     return web.Response(status=307, headers={"Location": url})
 
 
+def cache_age_headers(stored_at: float | None) -> dict[str, str]:
+    age = time.time() - stored_at if stored_at else 0
+    return {"X-Cache-Age": str(int(age))}
+
+
 def instagram_id_to_url(instagram_id):
     # Split if there's an underscore
     if "_" in str(instagram_id):
@@ -68,7 +105,8 @@ async def embed(request: aiohttp.web_request.Request):
         return web.Response(status=404)
 
     if post_id[0] == "B" or post_id[0] == "_":
-        resolve_id = await resolve_share_id(post_id)
+        with span("resolve_share_id"):
+            resolve_id = await resolve_share_id(post_id)
         if resolve_id:
             post_id = resolve_id
         else:
@@ -76,7 +114,7 @@ async def embed(request: aiohttp.web_request.Request):
             return RedirectResponse(ig_url)
 
     try:
-        post = await get_post(post_id)
+        post, stored_at = await get_post_versioned(post_id)
     except RestrictedError as e:
         logger.error(f"[{post_id}] Failed to get post: {e}")
         error_resp = render_error(
@@ -89,11 +127,42 @@ async def embed(request: aiohttp.web_request.Request):
         )
 
     # logger.debug(f"embed({post_id})")
-    # Return to original post if no post found
+    # Return to original post if no post found (or, with the upstream
+    # circuit breakers open, without waiting on Instagram at all)
     if not post:
         logger.warning(f"[{post_id}] Failed to get post, might be not found")
         return RedirectResponse(ig_url)
 
+    # Everything the page depends on besides the post. ig_url carries the
+    # request path and query, which end up in the page.
+    is_discord = "discord" in request.headers.get("User-Agent", "").lower()
+    is_direct = bool(request.query.get("direct"))
+    response_key = (
+        "embed",
+        post_id,
+        media_num,
+        bool(request.query.get("gallery")),
+        is_discord,
+        request.headers.get("Host", ""),
+        ig_url,
+    )
+    is_grid = (
+        media_num == 0
+        and post["medias"][0]["type"] == "GraphImage"
+        and len(post["medias"]) > 1
+    )
+    if is_grid:
+        # The client fetches the grid right after reading the page
+        prefetch_grid(request, post)
+
+    if stored_at and not is_direct:
+        if body := response_cache.get(response_key, stored_at):
+            return web.Response(
+                body=body,
+                content_type="text/html",
+                headers=cache_age_headers(stored_at),
+            )
+
     jinja_ctx = {
         "theme_color": "#0084ff",
         "username": post["user"]["username"],
@@ -104,28 +173,25 @@ async def embed(request: aiohttp.web_request.Request):
         "media_width": post["medias"][max(1, media_num) - 1]["width"],
         "media_height": post["medias"][max(1, media_num) - 1]["height"],
     }
-    if (
-        media_num == 0
-        and post["medias"][0]["type"] == "GraphImage"
-        and len(post["medias"]) > 1
-    ):
+    if is_grid:
         jinja_ctx["image_url"] = f"/grid/{post['post_id']}/"
-        # TODO: add media_width and media_height
-        jinja_ctx["media_width"] = 0
-        jinja_ctx["media_height"] = 0
+        # Same layout as the grid will get, 0 x 0 if a dimension is unknown
+        plan = grid_plan(post)
+        jinja_ctx["media_width"] = plan.width if plan else 0
+        jinja_ctx["media_height"] = plan.height if plan else 0
     elif post["medias"][max(1, media_num) - 1]["type"] == "GraphImage":
         jinja_ctx["image_url"] = f"/images/{post['post_id']}/{max(1, media_num)}"
     else:
         jinja_ctx["video_url"] = f"/videos/{post['post_id']}/{max(1, media_num)}"
 
     # direct = redirect to media url
-    if request.query.get("direct"):
+    if is_direct:
         return RedirectResponse(
             jinja_ctx.get("image_url", jinja_ctx.get("video_url", ""))
         )
 
     # oembed only for discord
-    if "discord" in request.headers.get("User-Agent", "").lower():
+    if is_discord:
         host = request.headers.get("Host", "")
         oembed_endpoint = f"https://{host}/oembed/?"
         oembed_params = {"author_name": post["caption"], "author_url": ig_url}
@@ -152,8 +218,14 @@ async def embed(request: aiohttp.web_request.Request):
         jinja_ctx["oembed_url"] = ""
         jinja_ctx["mastodon_statuses_url"] = None
 
+    with span("render_embed"):
+        body = render_embed(**jinja_ctx).encode()
+    if stored_at:
+        response_cache.set(response_key, stored_at, body)
     return web.Response(
-        body=render_embed(**jinja_ctx).encode(), content_type="text/html"
+        body=body,
+        content_type="text/html",
+        headers=cache_age_headers(stored_at),
     )
 
 
@@ -178,16 +250,129 @@ async def media_redirect(request: aiohttp.web_request.Request):
     return RedirectResponse(media["url"])
 
 
-grid_sf = Singleflight[str, str | None]()
+grid_sf = Singleflight[str, GridResult | None](
+    retain=config.get("SINGLEFLIGHT_RETAIN", 1.0)
+)
+
+grid_requests = Counter(
+    "instafix_grid_requests_total",
+    "Grid requests by result: cached file, generated (or joined), or fallen back",
+    ("result",),
+)
+
+# Grids started by the embed page, before the client asks for them. Only
+# while fewer renders than this are pending, so speculative work never
+# queues up in front of real requests.
+GRID_PREFETCH = config.get("GRID_PREFETCH", True)
+GRID_PREFETCH_MAX_PENDING = config.get("GRID_PREFETCH_MAX_PENDING", grid_pool.workers)
+grid_prefetch = Counter(
+    "instafix_grid_prefetch_total",
+    "Speculative grid builds: built, skipped (pool busy), saturated or failed",
+    ("result",),
+)
+_prefetching: dict[str, asyncio.Task] = {}
+
+# Grids never change for a given post, let clients and proxies keep them
+GRID_CACHE_CONTROL = "public, max-age=31536000, immutable"
+GRID_CONTENT_TYPES = {".jpeg": "image/jpeg", ".webp": "image/webp"}
+
+
+def grid_name(request: web.Request, post_id: str) -> str:
+    """Grid file for the request: WebP if the client takes it, else JPEG."""
+    if "image/webp" in request.headers.get("Accept", ""):
+        return f"{post_id}.webp"
+    return f"{post_id}.jpeg"
+
+
+def grid_plan(post: Post) -> GridPlan | None:
+    """Layout of the grid of `post`'s images, from the scraped dimensions."""
+    return plan_grid(
+        [
+            (media["width"], media["height"])
+            for media in post["medias"]
+            if media["type"] == "GraphImage"
+        ]
+    )
+
+
+def GridResponse(path: str):
+    # FileResponse serves via sendfile and handles ETag / Last-Modified,
+    # If-None-Match / If-Modified-Since (304), Range and HEAD for us
+    return web.FileResponse(
+        path,
+        headers={
+            "Cache-Control": GRID_CACHE_CONTROL,
+            "Content-Type": GRID_CONTENT_TYPES[os.path.splitext(path)[1]],
+            # The format depends on Accept
+            "Vary": "Accept",
+        },
+    )
+
+
+async def build_grid(post: Post, name: str) -> GridResult | None:
+    """Generate grid `name` for `post`, or join the build already running."""
+    images = [media["url"] for media in post["medias"] if media["type"] == "GraphImage"]
+    grid_path = grid_cache.path(name)
+    plan = grid_plan(post)
+    result = await grid_sf.do(name, grid_from_urls, images, grid_path, plan)
+    if result is not None:
+        grid_cache.add(name, result.size)
+    return result
+
+
+def prefetch_grid_name(request: web.Request, post_id: str) -> str | None:
+    """
+    Grid file the client will most likely ask for after the embed page,
+    or None if its Accept header does not tell.
+
+    The image is requested with its own Accept header. Only a client
+    listing WebP, or one sending nothing specific (which crawlers tend to
+    do for every request), is predictable: an HTML-only Accept header
+    says nothing about the image formats the client takes.
+    """
+    accept = request.headers.get("Accept", "").strip()
+    if "image/webp" in accept:
+        return f"{post_id}.webp"
+    if accept in ("", "*/*"):
+        return f"{post_id}.jpeg"
+    return None
+
+
+def prefetch_grid(request: web.Request, post: Post):
+    """
+    Start building the grid in the background, in the format this client
+    would likely get, unless it exists or the render pool is already busy.
+    """
+    name = prefetch_grid_name(request, post["post_id"])
+    if not GRID_PREFETCH or name is None:
+        return
+    if name in _prefetching or name in grid_cache:
+        return
+    if grid_pool.stats["pending"] >= GRID_PREFETCH_MAX_PENDING:
+        grid_prefetch.inc("skipped")
+        return
+
+    async def prefetch():
+        try:
+            if await build_grid(post, name):
+                grid_prefetch.inc("built")
+        except PoolSaturatedError:
+            grid_prefetch.inc("saturated")
+        except Exception as e:
+            logger.warning(f"[{post['post_id']}] Failed to prefetch grid: {e}")
+            grid_prefetch.inc("failed")
+        finally:
+            del _prefetching[name]
+
+    _prefetching[name] = asyncio.create_task(prefetch())
 
 
 async def grid(request: aiohttp.web_request.Request):
     post_id = request.match_info.get("post_id", "")
-    grid_cache_cb(post_id)  # for LFU caching
-
-    if os.path.exists(f"cache/grid/{post_id}.jpeg"):
-        with open(f"cache/grid/{post_id}.jpeg", "rb") as f:
-            return web.Response(body=f.read(), content_type="image/jpeg")
+    name = grid_name(request, post_id)
+    if grid_path := await grid_cache.get(name):
+        grid_requests.inc("hit")
+        return GridResponse(grid_path)
 
     try:
         post = await get_post(post_id)
@@ -196,36 +381,110 @@ async def grid(request: aiohttp.web_request.Request):
     except RestrictedError as e:
         return RedirectResponse(f"https://www.instagram.com/p/{post_id}")
 
-    images = [media["url"] for media in post["medias"] if media["type"] == "GraphImage"]
-    if len(images) == 0:
+    if not any(media["type"] == "GraphImage" for media in post["medias"]):
         return RedirectResponse(f"/images/{post_id}/1")
 
     try:
-        await grid_sf.do(post_id, grid_from_urls, images, f"cache/grid/{post_id}.jpeg")
+        # Joins the build started by the embed, if it is still running
+        joined = grid_sf.waiters(name) > 0
+        prefetched = name in _prefetching
+        try:
+            result = await build_grid(post, name)
+        except PoolSaturatedError:
+            if not prefetched:
+                raise
+            # The pool turned the speculative build down, not this request:
+            # give it its own try
+            result = await build_grid(post, name)
+        if result is None:
+            raise ValueError("No layout for the images")
+    except PoolSaturatedError as e:
+        logger.warning(f"[{post_id}] Grid render pool saturated: {e}")
+        grid_requests.inc("saturated")
+        return RedirectResponse(f"/images/{post_id}/1")
     except Exception as e:
         logger.error(f"[{post_id}] Failed to generate grid image: {e}")
+        grid_requests.inc("failed")
         return RedirectResponse(f"/images/{post_id}/1")
 
-    with open(f"cache/grid/{post_id}.jpeg", "rb") as f:
-        return web.Response(body=f.read(), content_type="image/jpeg")
+    grid_requests.inc("joined" if joined else "miss")
+    return GridResponse(result.path)
+
+
+@collector
+def _metrics():
+    flights = {"scraper": scraper_sf.stats, "grid": grid_sf.stats}
+    yield family(
+        "instafix_singleflight_total",
+        "counter",
+        "Singleflight calls: executed, deduplicated onto a running call, or "
+        "served a retained result",
+        ("name", "result"),
+        [
+            sample
+            for name, sf in flights.items()
+            for sample in (
+                ((name, "executed"), sf["executions"]),
+                (
+                    (name, "deduplicated"),
+                    sf["requests"] - sf["executions"] - sf["retained_hits"],
+                ),
+                ((name, "retained"), sf["retained_hits"]),
+            )
+        ],
+    )
+    yield family(
+        "instafix_singleflight_in_flight",
+        "gauge",
+        "Keys currently being computed",
+        ("name",),
+        [((name,), sf["in_flight"]) for name, sf in flights.items()],
+    )
+    pool = grid_pool.stats
+    yield family(
+        "instafix_grid_pool_pending",
+        "gauge",
+        "Grid renders admitted (queued or running)",
+        (),
+        [((), pool["pending"])],
+    )
+    yield family(
+        "instafix_grid_pool_memory_bytes",
+        "gauge",
+        "Estimated memory charged by running grid renders",
+        (),
+        [((), pool["memory"])],
+    )
+    yield family(
+        "instafix_grid_pool_rejected_total",
+        "counter",
+        "Grid renders refused by admission control",
+        (),
+        [((), pool["rejected"])],
+    )
 
 
 async def oembed(request: aiohttp.web_request.Request):
     author_name = request.query.get("author_name", "")
     author_url = request.query.get("author_url", "")
-    return web.Response(
-        text=json.dumps(
-            {
-                "author_name": author_name,
-                "author_url": author_url,
-                "provider_name": "InstaFix - Fix Instagram Embed",
-                "provider_url": "https://github.com/Wikidepia/InstaFix",
-                "title": "Embed",
-                "type": "rich",
-                "version": "1.0",
-            }
-        )
-    )
+    # Depends on the query only, so it never goes stale
+    response_key = ("oembed", author_name, author_url)
+    if body := response_cache.get(response_key, None):
+        return web.Response(body=body, content_type="text/plain", charset="utf-8")
+
+    body = json.dumps(
+        {
+            "author_name": author_name,
+            "author_url": author_url,
+            "provider_name": "InstaFix - Fix Instagram Embed",
+            "provider_url": "https://github.com/Wikidepia/InstaFix",
+            "title": "Embed",
+            "type": "rich",
+            "version": "1.0",
+        }
+    ).encode()
+    response_cache.set(response_key, None, body)
+    return web.Response(body=body, content_type="text/plain", charset="utf-8")
 
 
 async def mastodon_statuses(request: aiohttp.web_request.Request):
@@ -241,12 +500,21 @@ async def mastodon_statuses(request: aiohttp.web_request.Request):
     host = request.headers.get("Host", "")
 
     try:
-        post = await get_post(post_id)
+        post, stored_at = await get_post_versioned(post_id)
         if not post:
             raise RestrictedError(message="Unknown error (1)")
     except RestrictedError as e:
         return RedirectResponse(f"https://www.instagram.com/p/{post_id}")
 
+    response_key = ("statuses", post_id, host)
+    if stored_at and (body := response_cache.get(response_key, stored_at)):
+        return web.Response(
+            body=body,
+            content_type="text/plain",
+            charset="utf-8",
+            headers=cache_age_headers(stored_at),
+        )
+
     # activitypub caption/content must be a html
     caption = post["caption"].replace("\n", "<br>")
 
@@ -300,66 +568,87 @@ async def mastodon_statuses(request: aiohttp.web_request.Request):
                 }
             )
 
-    return web.Response(
-        text=json.dumps(
-            {
+    body = json.dumps(
+        {
+            "id": 0,
+            "url": f"https://www.instagram.com/p/{post['post_id']}",
+            "uri": f"https://www.instagram.com/p/{post['post_id']}",
+            # "created_at": "2025-04-11T06:34:46.886Z",
+            "edited_at": None,
+            "reblog": None,
+            "in_reply_to_id": None,
+            "in_reply_to_account_id": None,
+            "language": "en",
+            "content": caption,
+            "spoiler_text": "",
+            "visibility": "public",
+            "application": {
+                "name": "InstaFix",
+                "website": None,
+            },
+            "media_attachments": media_attachments,
+            "account": {
                 "id": 0,
-                "url": f"https://www.instagram.com/p/{post['post_id']}",
-                "uri": f"https://www.instagram.com/p/{post['post_id']}",
-                # "created_at": "2025-04-11T06:34:46.886Z",
-                "edited_at": None,
-                "reblog": None,
-                "in_reply_to_id": None,
-                "in_reply_to_account_id": None,
-                "language": "en",
-                "content": caption,
-                "spoiler_text": "",
-                "visibility": "public",
-                "application": {
-                    "name": "InstaFix",
-                    "website": None,
-                },
-                "media_attachments": media_attachments,
-                "account": {
-                    "id": 0,
-                    "display_name": post["user"].get("full_name", ""),
-                    "username": post["user"]["username"],
-                    "acct": post["user"]["username"],
-                    "url": f"https://www.instagram.com/{post['user']['username']}",
-                    "uri": f"https://www.instagram.com/{post['user']['username']}",
-                    # "created_at": "2025-05-11T06:34:46.886Z",
-                    "locked": False,
-                    "bot": False,
-                    "discoverable": True,
-                    "indexable": False,
-                    "group": False,
-                    "avatar": post["user"]["profile_pic"],
-                    "avatar_static": post["user"]["profile_pic"],
-                    "header": None,
-                    "header_static": None,
-                    "followers_count": 0,
-                    "following_count": 0,
-                    "statuses_count": 0,
-                    "hide_collections": False,
-                    "noindex": False,
-                    "emojis": [],
-                    "roles": [],
-                    "fields": [],
-                },
-                "mentions": [],
-                "tags": [],
+                "display_name": post["user"].get("full_name", ""),
+                "username": post["user"]["username"],
+                "acct": post["user"]["username"],
+                "url": f"https://www.instagram.com/{post['user']['username']}",
+                "uri": f"https://www.instagram.com/{post['user']['username']}",
+                # "created_at": "2025-05-11T06:34:46.886Z",
+                "locked": False,
+                "bot": False,
+                "discoverable": True,
+                "indexable": False,
+                "group": False,
+                "avatar": post["user"]["profile_pic"],
+                "avatar_static": post["user"]["profile_pic"],
+                "header": None,
+                "header_static": None,
+                "followers_count": 0,
+                "following_count": 0,
+                "statuses_count": 0,
+                "hide_collections": False,
+                "noindex": False,
                 "emojis": [],
-                "card": None,
-                "poll": None,
-            }
-        )
+                "roles": [],
+                "fields": [],
+            },
+            "mentions": [],
+            "tags": [],
+            "emojis": [],
+            "card": None,
+            "poll": None,
+        }
+    ).encode()
+    if stored_at:
+        response_cache.set(response_key, stored_at, body)
+    return web.Response(
+        body=body,
+        content_type="text/plain",
+        charset="utf-8",
+        headers=cache_age_headers(stored_at),
+    )
+
+
+# /metrics is only served, to requests bearing this token, when it is set
+METRICS_TOKEN = config.get("METRICS_TOKEN", "")
+
+
+async def metrics(request: aiohttp.web_request.Request):
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return web.Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return web.Response(
+        text=render_metrics(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
     )
 
 
 async def api_post_json(request: aiohttp.web_request.Request):
     post_id = request.match_info.get("post_id", "")
     if post_id[0] == "B" or post_id[0] == "_":
-        resolve_id = await resolve_share_id(post_id)
+        with span("resolve_share_id"):
+            resolve_id = await resolve_share_id(post_id)
         if resolve_id:
             post_id = resolve_id
         else:
@@ -367,12 +656,14 @@ async def api_post_json(request: aiohttp.web_request.Request):
             return web.Response(status=404, text="Post not found")
 
     try:
-        post = await get_post(post_id)
+        post, stored_at = await get_post_versioned(post_id)
     except RestrictedError as e:
         logger.error(f"[{post_id}] Failed to get post: {e}")
         return web.Response(status=403, text=f"Access denied: {e.message}")
 
     if not post:
+        if upstream_down():
+            return web.Response(status=503, text="Instagram is unavailable")
         logger.warning(f"[{post_id}] Failed to get post, might be not found")
         return web.Response(status=404, text="Post not found")
 
@@ -412,18 +703,23 @@ async def api_post_json(request: aiohttp.web_request.Request):
 
     return web.Response(
         text=json.dumps(response_data, indent=2),
-        content_type="application/json"
+        content_type="application/json",
+        headers=cache_age_headers(stored_at),
     )
 
 
-if __name__ == "__main__":
-    import asyncio
+async def log_ready(app):
+    logger.info(f"Startup done in {process_age() * 1000:.0f}ms, binding")
 
-    import uvloop
 
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-
-    app = web.Application()
+def create_app(owner: bool = True) -> web.Application:
+    """`owner` is false for every worker process but one, see CACHE_OWNER."""
+    app = web.Application(middlewares=[metrics_middleware, timing_middleware])
+    app.cleanup_ctx.append(client_session_ctx)
+    app.cleanup_ctx.append(grid_pool_ctx)
+    app.cleanup_ctx.append(cache_ctx)
+    app[CACHE_OWNER] = owner
+    app.on_startup.append(log_ready)
     app.add_routes(
         [
             web.get("/", home),
@@ -463,7 +759,42 @@ if __name__ == "__main__":
             web.get("/api/p/{post_id}", api_post_json),
         ]
     )
+    if METRICS_TOKEN:
+        app.router.add_get("/metrics", metrics)
+    return app
+
+
+def run_worker(index: int, heartbeat, host: str, port: int):
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    logger.info(f"Worker {index} imported in {process_age() * 1000:.0f}ms")
+    set_worker(index)
+    app = create_app(owner=index == 0)
+    app.cleanup_ctx.append(heartbeat_ctx(heartbeat))
+    web.run_app(app, host=host, port=port, reuse_port=True, print=None)
+
+
+if __name__ == "__main__":
     host = config.get("HOST", "127.0.0.1")
     port = config.get("PORT", 3000)
-    logger.info(f"Starting server on http://{host}:{port}")
-    web.run_app(app, host=host, port=port)
+    workers = config.get("WORKERS", 1)
+    if workers > 1:
+        logger.info(f"Starting {workers} workers on http://{host}:{port}")
+        Supervisor(
+            run_worker,
+            workers,
+            args=(host, port),
+            timeout=config.get("WORKER_TIMEOUT", 30),
+            startup_timeout=config.get("WORKER_STARTUP_TIMEOUT", 60),
+            shutdown_timeout=config.get("WORKER_SHUTDOWN_TIMEOUT", 30),
+        ).run()
+    else:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        logger.info(f"Imported in {process_age() * 1000:.0f}ms")
+        logger.info(f"Starting server on http://{host}:{port}")
+        web.run_app(create_app(), host=host, port=port)
@@ -1,29 +1,438 @@
-import marshal
-from typing import Any
+import asyncio
+import bisect
+import time
+from typing import NamedTuple
 
-from cache import post_cache
+from loguru import logger
+
+from cache import post_cache, post_l1_cache
+from config import config
+from internal.metrics import Counter, collector, family
+from internal.retry import CircuitOpenError, FailFastError
 from internal.singleflight import Singleflight
-from scrapers.api import get_query_api
-from scrapers.data import Post
-from scrapers.embed import get_embed
+from internal.timing import span
+from scrapers.api import get_query_api, graphql_breaker
+from scrapers.codec import (
+    decode_negative,
+    decode_post,
+    encode_negative,
+    encode_post,
+    is_negative,
+)
+from scrapers.data import (
+    Post,
+    RestrictedError,
+    UpstreamError,
+    breakers,
+    limiters,
+)
+from scrapers.embed import embed_breaker, get_embed
+from scrapers.proxy import proxy_pool
+
+NOT_FOUND_TTL = config.get("NEGATIVE_NOT_FOUND_TTL", 60)
+RESTRICTED_TTL = config.get("NEGATIVE_RESTRICTED_TTL", 600)
+# Posts older than this are served stale and refreshed in the background,
+# until they reach the post_cache (hard) TTL
+SOFT_TTL = config.get("POST_CACHE_SOFT_TTL", 24 * 60 * 60)
+# Start the GraphQL query if the embed page has not answered after this
+# long; negative to only ever try it after the embed page failed
+HEDGE_DELAY = config.get("HEDGE_DELAY_MS", 1500) / 1000
+
+scraper_sf = Singleflight[str, Post | None](
+    retain=config.get("SINGLEFLIGHT_RETAIN", 1.0)
+)
+
+# Scrapes avoided thanks to negative entries, by kind
+negative_hits = {"not_found": 0, "restricted": 0}
+# Stale posts served, and how their background refreshes went
+stale_stats = {"served": 0, "refreshed": 0, "reloaded": 0, "failed": 0}
+
+# Per scraping strategy: how often it ran, won, lost the race (cancelled)
+# or came back without a usable post, how often it was started early
+# because the other one was slow, and a latency histogram with upper
+# bounds HEDGE_BUCKETS_MS (the last bucket is everything above)
+HEDGE_BUCKETS_MS = (100, 250, 500, 1000, 1500, 2500, 5000, 10000)
+hedge_stats = {
+    name: {
+        "started": 0,
+        "wins": 0,
+        "cancelled": 0,
+        "failed": 0,
+        "hedged": 0,
+        "latency_ms": [0] * (len(HEDGE_BUCKETS_MS) + 1),
+    }
+    for name in ("embed", "graphql")
+}
+
+# How scrapes ended: won by "embed" or "graphql", or "restricted",
+# "not_found", "unavailable" (upstream failing fast)
+scrape_outcomes = Counter(
+    "instafix_scrape_total", "Upstream scrapes by outcome", ("outcome",)
+)
+
+_refreshing: dict[str, asyncio.Task] = {}
+
+
+class NegativeEntry(NamedTuple):
+    # None when the post was not found
+    message: str | None
+
+
+class CachedPost(NamedTuple):
+    post: Post | NegativeEntry
+    # seconds since the epoch
+    stored_at: float
+
+
+# Rough CPython (64-bit) sizes, to charge L1 entries for the decoded
+# objects they hold rather than their few encoded bytes
+_ENTRY_BYTES = 200  # CachedPost, the stored_at float, a NegativeEntry
+_DICT_BYTES = 360  # a post or media dict, empty
+_STR_BYTES = 49  # plus one byte per (ASCII) character
+
+
+def _cached_size(post: Post | NegativeEntry) -> int:
+    """Estimated memory held by an L1 entry for `post`."""
+    if isinstance(post, NegativeEntry):
+        return _ENTRY_BYTES + len(post.message or "")
+    size = _ENTRY_BYTES
+    for value in (post, post["user"], *post["medias"]):
+        size += _DICT_BYTES + 8
+        for item in value.values():
+            if isinstance(item, str):
+                size += _STR_BYTES + len(item)
+    return size
+
 
-scraper_sf = Singleflight[str, Post | None]()
+def upstream_down() -> bool:
+    """True while every scraping strategy is failing fast."""
+    return embed_breaker.is_open and graphql_breaker.is_open
+
+
+def _from_cache(cached: CachedPost) -> Post | None:
+    if isinstance(cached.post, NegativeEntry):
+        if cached.post.message is None:
+            negative_hits["not_found"] += 1
+            return None
+        negative_hits["restricted"] += 1
+        raise RestrictedError(message=cached.post.message)
+    return cached.post
 
 
 async def get_post(post_id: str, proxy: str = "") -> Post | None:
-    post = post_cache.get(post_id)
-    if post:
-        return marshal.loads(post)
+    """
+    Returns the post, or None if it could not be found.
+
+    Raises RestrictedError if the post is restricted. Both outcomes are
+    cached for a short while, so repeated requests do not hit upstream.
+    """
+    post, _ = await get_post_versioned(post_id, proxy)
+    return post
+
+
+async def get_post_versioned(
+    post_id: str, proxy: str = ""
+) -> tuple[Post | None, float | None]:
+    """
+    Same as `get_post`, also returning when the post was stored (seconds
+    since the epoch), which changes whenever the cached post does. It is
+    None for a post that was just scraped.
+    """
+    # L1: decoded posts kept in memory
+    cached = post_l1_cache.get(post_id)
+
+    # L2: LSM on disk
+    if cached is None:
+        with span("lsm"):
+            entry = await post_cache.get_entry(post_id)
+        post = None
+        if entry:
+            if is_negative(entry.value):
+                post = NegativeEntry(decode_negative(entry.value))
+            else:
+                try:
+                    post = decode_post(entry.value)
+                except ValueError as e:
+                    # Written in a format no longer read, scrape it again
+                    logger.debug(f"[{post_id}] Ignoring cached post: {e}")
+        if post is not None:
+            cached = CachedPost(post, entry.stored_at / 1e9)
+            post_l1_cache.set(
+                post_id,
+                cached,
+                size=_cached_size(post),
+                expires_at=entry.expires_at / 1e9,
+            )
+
+    if cached is not None:
+        age = time.time() - cached.stored_at
+        if age > SOFT_TTL and not isinstance(cached.post, NegativeEntry):
+            stale_stats["served"] += 1
+            _start_refresh(post_id, proxy)
+        return _from_cache(cached), cached.stored_at
+
+    with span("scrape"):
+        return await scraper_sf.do(post_id, _get_post, post_id, proxy), None
+
+
+def _store_post(post_id: str, post: Post):
+    raw = encode_post(post)
+    post_cache.set(post_id, raw)
+    post_l1_cache.set(
+        post_id, CachedPost(post, time.time()), size=_cached_size(post)
+    )
+
+
+def _store_negative(post_id: str, message: str | None, ttl: int):
+    entry = NegativeEntry(message)
+    post_cache.set(post_id, encode_negative(message), ttl=ttl)
+    post_l1_cache.set(
+        post_id,
+        CachedPost(entry, time.time()),
+        size=_cached_size(entry),
+        expires_at=time.time() + ttl,
+    )
+
 
-    return await scraper_sf.do(post_id, _get_post, post_id, proxy)
+def _usable(post: Post | None) -> bool:
+    return bool(post) and not post["blocked"]  # type: ignore[index]
+
+
+def _start_strategy(name: str, coro) -> asyncio.Task:
+    stats = hedge_stats[name]
+    stats["started"] += 1
+    started = time.perf_counter()
+
+    def record(task: asyncio.Task):
+        if task.cancelled():
+            stats["cancelled"] += 1
+            return
+        if task.exception() is not None or not _usable(task.result()):
+            stats["failed"] += 1
+        elapsed = (time.perf_counter() - started) * 1000
+        stats["latency_ms"][bisect.bisect_left(HEDGE_BUCKETS_MS, elapsed)] += 1
+
+    task = asyncio.create_task(coro, name=f"{name}:{coro.__name__}")
+    task.add_done_callback(record)
+    return task
+
+
+def _won(name: str):
+    hedge_stats[name]["wins"] += 1
+    scrape_outcomes.inc(name)
+
+
+async def _scrape(post_id: str, proxy: str = "") -> Post | None:
+    try:
+        post = await _race(post_id, proxy)
+    except RestrictedError:
+        scrape_outcomes.inc("restricted")
+        raise
+    except (FailFastError, UpstreamError):
+        scrape_outcomes.inc("unavailable")
+        raise
+    if post is None:
+        scrape_outcomes.inc("not_found")
+    return post
+
+
+async def _race(post_id: str, proxy: str = "") -> Post | None:
+    """
+    Scrape the embed page, and fall back to the GraphQL API if that fails
+    or the post is blocked there.
+
+    If the embed page takes longer than HEDGE_DELAY, the GraphQL query is
+    started alongside it and whichever returns a usable post first wins.
+
+    A strategy whose circuit breaker is open is skipped, and if both are,
+    CircuitOpenError is raised without waiting on upstream.
+    """
+    if embed_breaker.is_open:
+        if graphql_breaker.is_open:
+            raise CircuitOpenError("embed+graphql")
+        post = await _start_strategy("graphql", get_query_api(post_id, proxy))
+        if not _usable(post):
+            return None
+        _won("graphql")
+        return post
+
+    embed = _start_strategy("embed", get_embed(post_id, proxy))
+    tasks = [embed]
+    try:
+        if graphql_breaker.is_open:
+            await asyncio.wait(tasks)
+        elif HEDGE_DELAY >= 0:
+            await asyncio.wait(tasks, timeout=HEDGE_DELAY)
+        else:
+            await asyncio.wait(tasks)
+
+        if embed.done():
+            if embed.exception() is None and _usable(embed.result()):
+                _won("embed")
+                return embed.result()
+        else:
+            hedge_stats["graphql"]["hedged"] += 1
+
+        tasks.append(_start_strategy("graphql", get_query_api(post_id, proxy)))
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                try:
+                    post = task.result()
+                except Exception as e:
+                    # RestrictedError is the more useful one to report,
+                    # FailFastError / UpstreamError keep the miss from
+                    # being cached
+                    if error is None or isinstance(e, RestrictedError):
+                        error = e
+                    continue
+                if _usable(post):
+                    _won("embed" if task is embed else "graphql")
+                    return post
+        if error is not None:
+            raise error
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 async def _get_post(post_id: str, proxy: str = "") -> Post | None:
     # logger.debug(f"get_post({post_id})")
 
-    post = await get_embed(post_id, proxy)
-    if not post or post["blocked"]:
-        post = await get_query_api(post_id, proxy)
+    try:
+        post = await _scrape(post_id, proxy)
+    except RestrictedError as e:
+        _store_negative(post_id, e.message, RESTRICTED_TTL)
+        raise
+    except (FailFastError, UpstreamError) as e:
+        # Upstream is down or overloaded, not the post: do not remember it
+        # as not found
+        logger.warning(f"[{post_id}] Upstream unavailable, not caching: {e}")
+        return None
+
+    if post:
+        _store_post(post_id, post)
+    else:
+        _store_negative(post_id, None, NOT_FOUND_TTL)
+    return post
+
+
+async def _refresh_post(post_id: str, proxy: str = "") -> Post | None:
+    # A successful scrape replaces the stale entry, and so does the post
+    # turning out restricted. While upstream fails we keep serving stale
+    # data until the hard TTL
+    try:
+        post = await _scrape(post_id, proxy)
+    except RestrictedError as e:
+        _store_negative(post_id, e.message, RESTRICTED_TTL)
+        stale_stats["refreshed"] += 1
+        return None
+    except (FailFastError, UpstreamError) as e:
+        logger.warning(f"[{post_id}] Refresh failed, keeping stale post: {e}")
+        post = None
+
     if post:
-        post_cache.set(post_id, marshal.dumps(post))  # type: ignore
+        _store_post(post_id, post)
+        stale_stats["refreshed"] += 1
+    else:
+        stale_stats["failed"] += 1
     return post
+
+
+def _start_refresh(post_id: str, proxy: str = ""):
+    if post_id in _refreshing:
+        return
+
+    async def refresh():
+        try:
+            # With several workers each has its own L1: another one may
+            # have refreshed the post already, then only reload it
+            entry = await post_cache.get_entry(post_id)
+            if entry and time.time() - entry.stored_at / 1e9 <= SOFT_TTL:
+                post_l1_cache.pop(post_id)
+                stale_stats["reloaded"] += 1
+                return
+            await scraper_sf.do(post_id, _refresh_post, post_id, proxy)
+        except Exception as e:
+            logger.error(f"[{post_id}] Failed to refresh post: {e}")
+        finally:
+            del _refreshing[post_id]
+
+    _refreshing[post_id] = asyncio.create_task(refresh())
+
+
+@collector
+def _metrics():
+    yield family(
+        "instafix_negative_cache_hits_total",
+        "counter",
+        "Scrapes avoided thanks to cached not found / restricted posts",
+        ("kind",),
+        (((kind,), value) for kind, value in negative_hits.items()),
+    )
+    yield family(
+        "instafix_stale_posts_total",
+        "counter",
+        "Stale posts served, and how their background refreshes went",
+        ("event",),
+        (((event,), value) for event, value in stale_stats.items()),
+    )
+    for event in ("started", "wins", "cancelled", "failed", "hedged"):
+        yield family(
+            f"instafix_scraper_{event}_total",
+            "counter",
+            f"Scraping strategy runs: {event}",
+            ("strategy",),
+            (((name,), stats[event]) for name, stats in hedge_stats.items()),
+        )
+
+    yield family(
+        "instafix_circuit_open",
+        "gauge",
+        "1 while the endpoint's circuit breaker refuses calls",
+        ("endpoint",),
+        (((name,), int(breaker.is_open)) for name, breaker in breakers.items()),
+    )
+    yield family(
+        "instafix_circuit_rejected_total",
+        "counter",
+        "Calls refused by an open circuit breaker",
+        ("endpoint",),
+        (((name,), breaker.rejected) for name, breaker in breakers.items()),
+    )
+
+    limits = {host: limiter.stats for host, limiter in limiters.items()}
+    for key, name, kind, help in (
+        ("limit", "limit", "gauge", "Current adaptive concurrency limit"),
+        ("in_flight", "in_flight", "gauge", "Requests in flight"),
+        ("queue", "queue", "gauge", "Requests waiting for a slot"),
+        ("rejected", "rejected_total", "counter", "Requests refused, queue full"),
+    ):
+        yield family(
+            f"instafix_upstream_limiter_{name}",
+            kind,
+            help,
+            ("host",),
+            (((host,), stats[key]) for host, stats in limits.items()),
+        )
+
+    proxies = proxy_pool.stats
+    for key, name, kind, help in (
+        ("outstanding", "outstanding", "gauge", "Requests in flight"),
+        ("requests", "requests_total", "counter", "Requests sent"),
+        ("errors", "errors_total", "counter", "Requests that failed (429 / 5xx, timeouts)"),
+        ("ejected", "ejected", "gauge", "1 while the proxy is ejected"),
+        ("latency_ms", "latency_ms", "gauge", "Moving average of the latency"),
+    ):
+        yield family(
+            f"instafix_proxy_{name}",
+            kind,
+            help,
+            ("proxy",),
+            (((proxy,), stats[key]) for proxy, stats in proxies.items()),
+        )
@@ -4,7 +4,23 @@ import aiohttp
 import aiohttp.client_exceptions
 from loguru import logger
 
-from scrapers.data import HTTPSession, Media, Post, RestrictedError, User
+from config import config
+from internal.retry import FailFastError
+from internal.timing import span
+from scrapers.data import (
+    HTTPSession,
+    Media,
+    Post,
+    RestrictedError,
+    UpstreamError,
+    User,
+    is_not_found,
+    upstream_breaker,
+    upstream_retry,
+)
+
+graphql_breaker = upstream_breaker("graphql")
+graphql_retry = upstream_retry(config.get("GRAPHQL_ATTEMPTS", 3))
 
 
 def post_id_to_media_id(code: str) -> int:
@@ -69,20 +85,23 @@ async def get_query_api(post_id: str, proxy: str = "") -> Post | None:
         }
     )
 
-    MAX_RETRIES = 5
-    for i in range(MAX_RETRIES):
-        try:
-            async with HTTPSession(headers=headers) as session:
-                text = await session.http_post(
-                    "https://www.instagram.com/graphql/query", data=data
-                )
-                query_json = json.loads(text)
-                break
-        except Exception as e:
-            if i == MAX_RETRIES - 1:
-                logger.error(f"[{post_id}] Error when fetching post from API: {e}")
-    else:
-        return None
+    async def query() -> dict:
+        async with HTTPSession(headers=headers, proxy=proxy) as session:
+            text = await session.http_post(
+                "https://www.instagram.com/graphql/query", data=data
+            )
+            return json.loads(text)
+
+    try:
+        with span("graphql"):
+            query_json = await graphql_retry.run(graphql_breaker, query)
+    except FailFastError:
+        raise
+    except Exception as e:
+        if is_not_found(e):
+            return None
+        logger.error(f"[{post_id}] Error when fetching post from API: {e!r}")
+        raise UpstreamError(f"graphql: {e!r}") from e
 
     data = query_json.get("data")
     if not data:
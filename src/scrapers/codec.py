@@ -0,0 +1,124 @@
+"""
+Compact binary encoding for cached `Post` objects.
+
+Layout: one schema version byte, followed by a marshal dump of the post as
+positional tuples instead of dicts, so the field names are not repeated
+in every entry. Each dict becomes `(values, extra)`: `values` in the
+order of its field table below (`...` for a missing optional field), and
+`extra` holds keys missing from the table (None if there are none), so
+adding a field to `Post` never breaks encoding. The field tables are
+append-only: entries written with a shorter table decode without the new
+fields. Anything that changes the meaning of existing entries must bump
+`CODEC_VERSION`.
+
+Decoding is marshal plus a `dict(zip(...))` per dict, all in C; the
+version 1 format, a tag-by-tag encoding read in Python, was several times
+slower to decode than marshal and is no longer read (`decode_post`
+raises ValueError, and the entry is scraped again).
+
+Entries written before this codec existed are plain marshal dumps, which
+never start with a version byte; `decode_post` still reads them.
+
+Negative entries (post not found / restricted) start with
+`NEGATIVE_MARKER` instead, followed by the restriction message if any.
+"""
+
+import marshal
+
+from scrapers.data import Post
+
+CODEC_VERSION = 0x02
+NEGATIVE_MARKER = 0x00
+
+# Append-only
+POST_FIELDS = (
+    "post_id",
+    "user",
+    "caption",
+    "medias",
+    "blocked",
+    "timestamp",
+    "likes_count",
+    "comments_count",
+)
+USER_FIELDS = ("username", "full_name", "profile_pic")
+# Keep _unpack_media in sync
+MEDIA_FIELDS = ("url", "type", "width", "height", "duration", "preview_url")
+
+
+def _pack(fields: tuple[str, ...], value: dict) -> tuple | list:
+    values = tuple(value.get(field, ...) for field in fields)
+    if len(value) == len(fields) and ... not in values:
+        return values
+    extra = {key: item for key, item in value.items() if key not in fields}
+    return [values, extra]
+
+
+def _unpack(fields: tuple[str, ...], packed: tuple | list) -> dict:
+    if type(packed) is tuple:
+        return dict(zip(fields, packed))
+    values, extra = packed
+    result = {key: item for key, item in zip(fields, values) if item is not ...}
+    result.update(extra)
+    return result
+
+
+def _unpack_media(packed: tuple | list) -> dict:
+    # The common case spelled out as a dict display, which builds the
+    # dict about twice as fast as dict(zip(...))
+    if type(packed) is tuple and len(packed) == 6:
+        url, type_, width, height, duration, preview_url = packed
+        return {
+            "url": url,
+            "type": type_,
+            "width": width,
+            "height": height,
+            "duration": duration,
+            "preview_url": preview_url,
+        }
+    return _unpack(MEDIA_FIELDS, packed)
+
+
+def encode_post(post: Post) -> bytes:
+    values = dict(post)
+    if "user" in values:
+        values["user"] = _pack(USER_FIELDS, values["user"])
+    if "medias" in values:
+        values["medias"] = tuple(
+            _pack(MEDIA_FIELDS, media) for media in values["medias"]
+        )
+    return bytes((CODEC_VERSION,)) + marshal.dumps(_pack(POST_FIELDS, values))
+
+
+def decode_post(data: bytes) -> Post:
+    version = data[0]
+    if version != CODEC_VERSION:
+        # Written before the codec existed: marshal's dict type code, with
+        # or without its reference flag
+        if version & 0x7F == ord("{"):
+            return marshal.loads(data)
+        raise ValueError(f"Unsupported post codec version {version}")
+
+    post = _unpack(POST_FIELDS, marshal.loads(memoryview(data)[1:]))
+    if "user" in post:
+        post["user"] = _unpack(USER_FIELDS, post["user"])
+    if "medias" in post:
+        post["medias"] = [_unpack_media(media) for media in post["medias"]]
+    return post  # type: ignore[return-value]
+
+
+def encode_negative(message: str | None) -> bytes:
+    """Encode a negative entry, `message` is None for "not found"."""
+    if message is None:
+        return bytes((NEGATIVE_MARKER,))
+    return bytes((NEGATIVE_MARKER, 1)) + message.encode()
+
+
+def is_negative(data: bytes) -> bool:
+    return data[0] == NEGATIVE_MARKER
+
+
+def decode_negative(data: bytes) -> str | None:
+    if len(data) == 1:
+        return None
+    return data[2:].decode()
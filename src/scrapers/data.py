@@ -1,11 +1,20 @@
-import asyncio
+import contextlib
+import time
+from typing import AsyncIterator
 
 import aiohttp
 from typing_extensions import List, NotRequired, TypedDict
+from yarl import URL
 
 from config import config
+from internal.limiter import AdaptiveLimiter
+from internal.metrics import Histogram
+from internal.retry import CircuitBreaker, RetryPolicy
+from scrapers.proxy import Proxy, proxy_pool
 
-proxy_limit = asyncio.Semaphore(50)
+# Per request through a proxy, below UPSTREAM_TIMEOUT so that a slow proxy
+# is seen (and ejected) as timing out rather than the attempt cancelled
+PROXY_TIMEOUT = aiohttp.ClientTimeout(total=config.get("PROXY_TIMEOUT", 8))
 
 
 class User(TypedDict):
@@ -58,12 +67,115 @@ class RestrictedError(Exception):
         self.message = message
 
 
+class UpstreamError(Exception):
+    """
+    Instagram could not be reached or answered with an error (after
+    retries), so whether the post exists is unknown. Not to be cached as
+    not found.
+    """
+
+
+upstream_latency = Histogram(
+    "instafix_upstream_request_seconds",
+    "Latency of requests to Instagram by host and outcome",
+    ("host", "outcome"),
+)
+
+# One circuit breaker per upstream endpoint, by name, so callers (and
+# stats) can tell when an endpoint is failing fast
+breakers: dict[str, CircuitBreaker] = {}
+
+
+def upstream_breaker(name: str) -> CircuitBreaker:
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=config.get("BREAKER_FAILURES", 5),
+            reset_timeout=config.get("BREAKER_RESET_TIMEOUT", 30),
+        )
+    return breakers[name]
+
+
+def is_not_found(e: BaseException) -> bool:
+    """A definitive answer from upstream, not a sign it is failing."""
+    return isinstance(e, aiohttp.ClientResponseError) and e.status in (404, 410)
+
+
+def upstream_retry(attempts: int, give_up_on: tuple = ()) -> RetryPolicy:
+    return RetryPolicy(
+        attempts=attempts,
+        base_delay=config.get("RETRY_BASE_DELAY_MS", 250) / 1000,
+        max_delay=config.get("RETRY_MAX_DELAY_MS", 4000) / 1000,
+        timeout=config.get("UPSTREAM_TIMEOUT", 10),
+        give_up_on=give_up_on,
+        give_up_if=is_not_found,
+    )
+
+
+# Adaptive concurrency limit per upstream host
+limiters: dict[str, AdaptiveLimiter] = {}
+
+
+def upstream_limiter(url: str) -> AdaptiveLimiter:
+    host = URL(url).host or ""
+    if host not in limiters:
+        limiters[host] = AdaptiveLimiter(
+            initial=config.get("LIMITER_INITIAL", 20),
+            min_limit=config.get("LIMITER_MIN", 2),
+            max_limit=config.get("LIMITER_MAX", 200),
+            max_queue=config.get("LIMITER_MAX_QUEUE", 200),
+            latency_target=config.get("LIMITER_LATENCY_TARGET_MS", 3000) / 1000,
+            qps=config.get("UPSTREAM_QPS", {}).get(host, 0),
+        )
+    return limiters[host]
+
+
+_client_session: aiohttp.ClientSession | None = None
+
+
+def client_session() -> aiohttp.ClientSession:
+    """Return the process-wide upstream session, creating it on first use."""
+    global _client_session
+    if _client_session is None or _client_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=config.get("HTTP_POOL_LIMIT", 100),
+            limit_per_host=config.get("HTTP_POOL_LIMIT_PER_HOST", 50),
+            ttl_dns_cache=config.get("HTTP_DNS_CACHE_TTL", 300),
+            keepalive_timeout=config.get("HTTP_KEEPALIVE_TIMEOUT", 30),
+            ssl=False,
+        )
+        _client_session = aiohttp.ClientSession(connector=connector)
+    return _client_session
+
+
+async def close_client_session() -> None:
+    global _client_session
+    if _client_session is not None:
+        await _client_session.close()
+        _client_session = None
+
+
+async def client_session_ctx(app):
+    """aiohttp cleanup context owning the upstream session for the app lifetime."""
+    client_session()
+    yield
+    await close_client_session()
+
+
 # https://github.com/aio-libs/aiohttp/issues/4932#issuecomment-1611759696
 class HTTPSession:
-    def __init__(self, headers: dict[str, str] = {}):
-        self._session = aiohttp.ClientSession(
-            headers=headers, proxy=config.get("HTTP_PROXY", "")
-        )
+    """Per-call view over the shared upstream session.
+
+    Connections are pooled in `client_session()`, so entering and leaving
+    this context manager is cheap and never closes the underlying sockets.
+    Requests to Instagram go through `proxy_pool`, or through `proxy` when
+    one is given, under the adaptive limit of the target host.
+    """
+
+    def __init__(self, headers: dict[str, str] = {}, proxy: str = ""):
+        self._session = client_session()
+        self._headers = headers
+        self._proxy = proxy or None
 
     async def __aenter__(self) -> "HTTPSession":
         return self
@@ -77,32 +189,75 @@ class HTTPSession:
         await self.close()
 
     async def close(self) -> None:
-        await self._session.close()
+        # The shared session outlives us, nothing to release here.
+        pass
+
+    @contextlib.asynccontextmanager
+    async def _upstream(self, url: str) -> AsyncIterator[Proxy]:
+        # Concurrency slot for the host, then a proxy, then the request
+        host = URL(url).host or ""
+        async with upstream_limiter(url).slot() as slot, proxy_pool.lease(
+            self._proxy
+        ) as proxy:
+            # Waiting for a proxy is not upstream latency
+            slot.start()
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                yield proxy
+                outcome = "ok"
+            finally:
+                upstream_latency.observe(time.perf_counter() - started, host, outcome)
 
     async def http_get(
         self, url: str, params: dict = {}, ignore_status: bool = False
     ) -> str:
-        async with proxy_limit:
+        async with self._upstream(url) as proxy:
             async with self._session.request(
-                "GET", url, params=params, verify_ssl=False
+                "GET",
+                url,
+                params=params,
+                headers=self._headers,
+                proxy=proxy.url,
+                timeout=PROXY_TIMEOUT,
             ) as response:
                 if not ignore_status:
                     response.raise_for_status()
                 return await response.text()
 
+    @contextlib.asynccontextmanager
+    async def http_get_stream(self, url: str) -> AsyncIterator[aiohttp.ClientResponse]:
+        # Media is fetched straight from the CDN, without going through the
+        # proxy, and the body is left to the caller to read or stream
+        async with self._session.request(
+            "GET", url, headers=self._headers
+        ) as response:
+            response.raise_for_status()
+            yield response
+
     async def http_post(self, url: str, data: dict, ignore_status: bool = False) -> str:
-        async with proxy_limit:
+        async with self._upstream(url) as proxy:
             async with self._session.request(
-                "POST", url, data=data, verify_ssl=False
+                "POST",
+                url,
+                data=data,
+                headers=self._headers,
+                proxy=proxy.url,
+                timeout=PROXY_TIMEOUT,
             ) as response:
                 if not ignore_status:
                     response.raise_for_status()
                 return await response.text()
 
     async def http_redirect(self, url: str) -> str:
-        async with proxy_limit:
+        async with self._upstream(url) as proxy:
             async with self._session.request(
-                "HEAD", url, allow_redirects=False, verify_ssl=False
+                "HEAD",
+                url,
+                allow_redirects=False,
+                headers=self._headers,
+                proxy=proxy.url,
+                timeout=PROXY_TIMEOUT,
             ) as response:
                 response.raise_for_status()
                 return response.headers.get("location", "")
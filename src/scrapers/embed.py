@@ -5,20 +5,52 @@ import aiohttp.client_exceptions
 from loguru import logger
 from selectolax.parser import HTMLParser
 
+from config import config
 from internal.jslex import js_lexer_string
-from scrapers.data import HTTPSession, Media, Post, User
+from internal.retry import FailFastError
+from internal.timing import span
+from scrapers.data import (
+    HTTPSession,
+    Media,
+    Post,
+    UpstreamError,
+    User,
+    is_not_found,
+    upstream_breaker,
+    upstream_retry,
+)
+
+embed_breaker = upstream_breaker("embed")
+# The GraphQL query is the fallback, so by default the embed page is not retried
+embed_retry = upstream_retry(config.get("EMBED_ATTEMPTS", 1))
+
+
+async def fetch_embed_html(post_id: str, proxy: str = "") -> str:
+    async with HTTPSession(proxy=proxy) as session:
+        return await session.http_get(
+            f"https://www.instagram.com/p/{post_id}/embed/captioned/",
+        )
 
 
 async def get_embed(post_id: str, proxy: str = "") -> Post | None:
     try:
-        async with HTTPSession() as session:
-            html = await session.http_get(
-                f"https://www.instagram.com/p/{post_id}/embed/captioned/",
+        with span("embed_fetch"):
+            html = await embed_retry.run(
+                embed_breaker, fetch_embed_html, post_id, proxy
             )
+    except FailFastError:
+        raise
     except Exception as e:
-        logger.error(f"[{post_id}] Error when fetching post from embed: {e}")
-        return None
+        if is_not_found(e):
+            return None
+        logger.error(f"[{post_id}] Error when fetching post from embed: {e!r}")
+        raise UpstreamError(f"embed: {e!r}") from e
+
+    with span("embed_parse"):
+        return parse_embed(post_id, html)
+
 
+def parse_embed(post_id: str, html: str) -> Post | None:
     medias: List[Media] = []
     tree = HTMLParser(html)
     # ---- from timesliceimpl ----
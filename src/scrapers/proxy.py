@@ -0,0 +1,204 @@
+import asyncio
+import contextlib
+import time
+from typing import Any, AsyncIterator
+
+import aiohttp
+from loguru import logger
+from yarl import URL
+
+from config import config
+from internal.waitqueue import WaitQueue
+
+# Ejection doubles with each consecutive one, up to the max
+EJECT_SECONDS = config.get("PROXY_EJECT_SECONDS", 30)
+EJECT_MAX_SECONDS = config.get("PROXY_EJECT_MAX_SECONDS", 600)
+# Weight of the newest sample in the latency moving average
+LATENCY_ALPHA = 0.2
+
+
+class Proxy:
+    """One egress route (a proxy URL, or None for a direct connection)."""
+
+    def __init__(self, url: str | None, limit: int = 50, weight: float = 1.0):
+        self.url = url
+        self.limit = limit
+        self.weight = weight
+        # host:port, without credentials, for logs
+        self.name = f"{URL(url).host}:{URL(url).port}" if url else "direct"
+        # Position in the pool, for stats, which should not reveal hosts
+        self.label = "direct" if url is None else "proxy"
+
+        self.outstanding = 0
+        self.ejected_until = 0.0
+        self.ejections = 0  # consecutive, reset by a success
+        # Counters, for stats
+        self.requests = 0
+        self.errors = 0
+        self.ejected_total = 0
+        self.latency_ms = 0.0
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    def score(self) -> tuple[float, float]:
+        # Least outstanding relative to weight, then fastest
+        return ((self.outstanding + 1) / self.weight, self.latency_ms)
+
+    def record_success(self, elapsed_ms: float) -> None:
+        self.requests += 1
+        self.ejections = 0
+        if self.latency_ms:
+            self.latency_ms += LATENCY_ALPHA * (elapsed_ms - self.latency_ms)
+        else:
+            self.latency_ms = elapsed_ms
+
+    def record_failure(self, reason: str) -> None:
+        self.requests += 1
+        self.errors += 1
+        if self.url is None:
+            # A direct connection has nothing to be replaced by
+            return
+        self.ejections += 1
+        self.ejected_total += 1
+        duration = min(EJECT_MAX_SECONDS, EJECT_SECONDS * 2 ** (self.ejections - 1))
+        self.ejected_until = time.monotonic() + duration
+        logger.warning(f"Proxy {self.name} ejected for {duration}s: {reason}")
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejected": self.ejected,
+            "ejections": self.ejected_total,
+            "latency_ms": round(self.latency_ms, 1),
+        }
+
+
+class ProxyPool:
+    """
+    Spreads upstream requests over several proxies, each with its own
+    concurrency limit.
+
+    A request goes to the healthy proxy with the fewest outstanding
+    requests relative to its weight, and waits when every healthy proxy is
+    at its limit; waiters are served in order, one per freed slot. A proxy
+    answering 429 / 5xx or timing out is ejected for a while, and is
+    re-admitted once that passes. If every proxy is ejected, the one
+    re-admitted soonest is used anyway rather than failing outright.
+    """
+
+    def __init__(self, proxies: list[Proxy]):
+        self.proxies = proxies
+        self._by_url: dict[str | None, Proxy] = {}
+        for proxy in proxies:
+            self._add(proxy)
+        # Waiting requests, by pinned proxy URL (None for any)
+        self._waiters: WaitQueue[str | None, Proxy] = WaitQueue()
+
+    def get(self, url: str) -> Proxy:
+        """The proxy for `url`, added outside of the rotation if unknown."""
+        proxy = self._by_url.get(url)
+        if proxy is None:
+            proxy = self._add(Proxy(url, limit=config.get("PROXY_LIMIT", 50)))
+        return proxy
+
+    def _add(self, proxy: Proxy) -> Proxy:
+        if proxy.url is not None:
+            proxy.label = f"proxy-{len(self._by_url)}"
+        self._by_url[proxy.url] = proxy
+        return proxy
+
+    def _choose(self) -> Proxy | None:
+        healthy = [proxy for proxy in self.proxies if not proxy.ejected]
+        if not healthy:
+            # Every proxy is ejected, use the one closest to re-admission
+            healthy = [min(self.proxies, key=lambda proxy: proxy.ejected_until)]
+        available = [proxy for proxy in healthy if proxy.outstanding < proxy.limit]
+        if not available:
+            return None
+        return min(available, key=Proxy.score)
+
+    def _take(self, pin: str | None) -> Proxy | None:
+        if pin:
+            proxy: Proxy | None = self.get(pin)
+            if proxy.outstanding >= proxy.limit:
+                proxy = None
+        else:
+            proxy = self._choose()
+        if proxy is not None:
+            proxy.outstanding += 1
+        return proxy
+
+    def _wake(self) -> None:
+        self._waiters.wake(self._take)
+
+    async def _acquire(self, pin: str | None) -> Proxy:
+        # Waiters pinned to another, full proxy do not hold this one up
+        if not self._waiters.waiting(pin):
+            proxy = self._take(pin)
+            if proxy is not None:
+                return proxy
+        return await self._waiters.wait(pin, self._release)
+
+    def _release(self, proxy: Proxy) -> None:
+        proxy.outstanding -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def lease(self, pin: str | None = None) -> AsyncIterator[Proxy]:
+        """
+        Hold a slot on a proxy for one request, `pin` forces a proxy URL.
+
+        The outcome of the request is recorded from how the block exits;
+        a cancelled request (e.g. it lost a hedged race) counts for nothing.
+        """
+        proxy = await self._acquire(pin)
+        started = time.perf_counter()
+        try:
+            yield proxy
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429 or e.status >= 500:
+                proxy.record_failure(f"HTTP {e.status}")
+            else:
+                proxy.record_success((time.perf_counter() - started) * 1000)
+            raise
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            proxy.record_failure(repr(e))
+            raise
+        else:
+            proxy.record_success((time.perf_counter() - started) * 1000)
+        finally:
+            self._release(proxy)
+
+    @property
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {proxy.label: proxy.stats for proxy in self._by_url.values()}
+
+
+def _load_proxies() -> list[Proxy]:
+    limit = config.get("PROXY_LIMIT", 50)
+    entries = config.get("HTTP_PROXIES", [])
+    if not entries and config.get("HTTP_PROXY"):
+        entries = [config["HTTP_PROXY"]]
+
+    proxies = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        proxies.append(
+            Proxy(
+                entry["url"],
+                limit=entry.get("limit", limit),
+                weight=entry.get("weight", 1.0),
+            )
+        )
+    return proxies or [Proxy(None, limit=limit)]
+
+
+proxy_pool = ProxyPool(_load_proxies())
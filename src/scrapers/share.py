@@ -1,22 +1,37 @@
 import urllib.parse
 
 import aiohttp
+from loguru import logger
 
 from cache import shareid_cache
-from scrapers.data import HTTPSession
+from config import config
+from scrapers.data import HTTPSession, upstream_breaker, upstream_retry
 
+share_breaker = upstream_breaker("share")
+share_retry = upstream_retry(config.get("SHARE_ATTEMPTS", 2))
 
-async def resolve_share_id(post_id: str, proxy: str = "") -> str | None:
-    if cached := shareid_cache.get(post_id):
-        return cached
-    async with HTTPSession() as session:
-        location = await session.http_redirect(
+
+async def fetch_share_location(post_id: str, proxy: str = "") -> str:
+    async with HTTPSession(proxy=proxy) as session:
+        return await session.http_redirect(
             f"https://www.instagram.com/share/p/{post_id}/"
         )
-        if "/login" in location:
-            return None
+
+
+async def resolve_share_id(post_id: str, proxy: str = "") -> str | None:
+    if cached := await shareid_cache.get(post_id):
+        return cached.decode()
+    try:
+        location = await share_retry.run(
+            share_breaker, fetch_share_location, post_id, proxy
+        )
+    except Exception as e:
+        logger.error(f"[{post_id}] Error when resolving share id: {e!r}")
+        return None
+    if "/login" in location:
+        return None
     parts = urllib.parse.urlparse(location)
 
     new_post_id = parts.path.strip("/").split("/")[-1]
-    shareid_cache.set(post_id, new_post_id)
+    shareid_cache.set(post_id, new_post_id.encode())
     return new_post_id
@@ -45,6 +45,11 @@ def render_embed(
         <meta property="twitter:card" content="summary_large_image"/>
         <meta property="twitter:image" content="{image_url}"/>
     """
+        if media_width and media_height:
+            html += f"""
+        <meta property="og:image:width" content="{media_width}"/>
+        <meta property="og:image:height" content="{media_height}"/>
+    """
 
     if video_url:
         html += f"""